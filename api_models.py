@@ -0,0 +1,83 @@
+import json
+from typing import Generic, TypeVar
+from pydantic import TypeAdapter
+from typing_extensions import TypedDict, NotRequired  # pydantic needs typing_extensions' TypedDict before Python 3.12
+
+try:
+    import orjson
+except ImportError:  # Faster decoding of the JSON that isn't parsed by pydantic (e.g. response cache entries) is optional
+    orjson = None
+
+# Types of the API responses. A whole page is validated at once straight from the response bytes, so a change to the
+# API's schema fails on the first page, naming the field that changed, rather than as a KeyError part way through a
+# job. Keys the searches don't use are dropped. These are TypedDicts rather than BaseModels: validating a 200 row page
+# into plain dicts takes about a millisecond more than json.loads, and building a model per row took twice as long
+
+
+class TokenData(TypedDict):
+    # Transfers of ETH and ERC20 tokens have no token_id, and are skipped as assets that can't be found
+    token_address: NotRequired[str | None]
+    token_id: NotRequired[str | None]
+
+
+class Token(TypedDict):
+    data: TokenData
+
+
+class AssetResponse(TypedDict):
+    token_address: str
+    token_id: str
+    user: str
+    status: str | None
+    uri: str | None
+    name: str | None
+    description: str | None
+    image_url: str | None
+    metadata: dict | None
+    collection: dict | None
+    created_at: str
+    updated_at: str
+
+
+class TransferResponse(TypedDict):
+    transaction_id: int
+    status: str
+    user: str
+    receiver: str
+    timestamp: str
+    token: Token
+
+
+class MintResponse(TypedDict):
+    transaction_id: int
+    status: str
+    user: str
+    timestamp: str
+    token: Token
+
+
+class MintableTokenResponse(TypedDict):
+    blueprint: str
+
+
+ResultType = TypeVar("ResultType")
+
+
+class Page(TypedDict, Generic[ResultType]):
+    result: list[ResultType]
+    cursor: str
+    remaining: int
+
+
+# Building an adapter compiles its validator, so each one is built once here rather than per response
+ASSET_PAGE = TypeAdapter(Page[AssetResponse])
+TRANSFER_PAGE = TypeAdapter(Page[TransferResponse])
+MINT_PAGE = TypeAdapter(Page[MintResponse])
+ASSET = TypeAdapter(AssetResponse)
+MINTABLE_TOKEN = TypeAdapter(MintableTokenResponse)
+
+
+def loads(data: bytes | str):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from tortoise import Tortoise
+
+from db import setup_db
+from fake_api import FakeImxApi, FAKE_TOKEN_ADDRESS
+from models import Asset, Blueprint, Transfer, Mint
+from progress import ProgressReporter
+from searches import Searcher, DEFAULT_PREFETCH_WORKERS
+from utils import create_transfer_output_files, OUTPUT_FORMATS
+
+SCENARIOS = ("blueprint_prefetch", "collection_prefetch", "asset_search", "user_search", "export")
+
+
+async def count_db_rows() -> int:
+    return sum([await model.all().count() for model in (Asset, Blueprint, Transfer, Mint)])
+
+
+async def run_scenario(name: str, args, work_dir: Path) -> dict:
+    # Every scenario gets its own database and searcher, so results do not depend on which scenarios ran before
+    await setup_db(str(work_dir / f"{name}.sqlite3"))
+    api = FakeImxApi(args.tokens, args.users, args.transfers_per_token, latency=args.latency, max_page_size=args.page_size, error_rate=args.error_rate)
+    searcher = Searcher(ProgressReporter(), page_size=args.page_size, requests_per_second=args.requests_per_second, transport=api)
+    user_address = api.users[0]
+
+    try:
+        if name == "export":
+            # The export is timed on its own, from the transfers a user search stored
+            transfers, assets = await searcher.get_transfer_history_of_user(user_address, "in", True)
+
+        rows_before = await count_db_rows()
+        requests_before = api.num_requests
+        errors_before = api.num_errors
+        tracemalloc.start()
+        start_time = time.perf_counter()
+
+        if name == "blueprint_prefetch":
+            await searcher.blueprint_prefetch(FAKE_TOKEN_ADDRESS, 1, args.tokens + 1, args.workers)
+        elif name == "collection_prefetch":
+            await searcher.collection_prefetch(FAKE_TOKEN_ADDRESS, args.workers)
+        elif name == "asset_search":
+            await searcher.asset_search("Card 1", "metadata")
+        elif name == "user_search":
+            await searcher.get_transfer_history_of_user(user_address, "out", True)
+            await searcher.get_transfer_history_of_user(user_address, "in", True)
+            await searcher.get_minted_assets(user_address, True)
+        elif name == "export":
+            await create_transfer_output_files(transfers, assets, "in", work_dir, name, args.format)
+
+        seconds = time.perf_counter() - start_time
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rows_written = await count_db_rows() - rows_before
+        num_requests = api.num_requests - requests_before
+        num_errors = api.num_errors - errors_before
+    finally:
+        await searcher.close()
+        await Tortoise.close_connections()
+
+    result = {
+        "scenario": name,
+        "seconds": seconds,
+        "requests": num_requests,
+        "requests_per_second": num_requests / seconds,
+        "rate_limited": num_errors,
+        "db_rows": rows_written,
+        "db_rows_per_second": rows_written / seconds,
+        "peak_memory_mb": peak_memory / 2 ** 20,
+    }
+    if name == "export":
+        result["exported_rows"] = len(transfers)
+        result["exported_rows_per_second"] = len(transfers) / seconds
+    return result
+
+
+def print_results(results: list[dict]) -> None:
+    columns = ("scenario", "seconds", "requests", "requests_per_second", "rate_limited", "db_rows", "db_rows_per_second", "peak_memory_mb")
+    table = [columns] + [tuple(f"{result[column]:.2f}" if isinstance(result[column], float) else str(result[column]) for column in columns) for result in results]
+    widths = [max(len(row[i]) for row in table) for i in range(len(columns))]
+    for row in table:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+
+async def main(args) -> int:
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in args.scenarios or SCENARIOS:
+            results.append(await run_scenario(name, args, Path(work_dir)))
+
+    print_results(results)
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": {key: value for key, value in vars(args).items() if key != "json"}, "results": results}, f, indent=2)
+    return 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark Searcher against a local fake of the IMX API")
+    parser.add_argument("--scenario", dest="scenarios", action="append", choices=SCENARIOS, help="Scenario to run; repeat for several (default all)")
+    parser.add_argument("--tokens", type=int, default=500, help="Number of tokens in the fake collection")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--transfers-per-token", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds the fake API waits before every response")
+    parser.add_argument("--page-size", type=int, default=200, help="Largest page the fake API returns")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument("--requests-per-second", type=float, default=1000, help="Searcher rate limit; the real API allows 5")
+    parser.add_argument("--workers", type=int, default=DEFAULT_PREFETCH_WORKERS, help="Blueprint prefetch workers")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv", help="Export format")
+    parser.add_argument("--json", help="Also write the results to this file")
+    return parser
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(get_parser().parse_args())))
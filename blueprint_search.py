@@ -0,0 +1,87 @@
+from difflib import SequenceMatcher
+from tortoise import connections
+
+BLUEPRINT_NAME_INDEX = "blueprint_name_fts"
+MAX_MATCHES = 20
+MIN_SIMILARITY = 0.5  # difflib ratio a name needs to count as a fuzzy match when it does not contain the query
+CANDIDATES_PER_MATCH = 5  # How many names that share trigrams with the query are scored for each match returned
+
+
+def quote(term: str) -> str:
+    # FTS5 string literal, so the query's punctuation (e.g. "#" or "-") is matched rather than parsed
+    return '"' + term.replace('"', '""') + '"'
+
+
+def get_trigrams(text: str) -> list[str]:
+    text = text.lower()
+    return sorted({text[i:i + 3] for i in range(len(text) - 2)})
+
+
+async def create_blueprint_name_index() -> None:
+    # An FTS5 table with one row per distinct blueprint name. The trigram tokenizer makes any 3+ character substring
+    # searchable, which also lets names sharing a few trigrams with a misspelt query be found
+    connection = connections.get("default")
+    await connection.execute_script(f'CREATE VIRTUAL TABLE IF NOT EXISTS "{BLUEPRINT_NAME_INDEX}" USING fts5(name, tokenize="trigram")')
+
+    # Blueprints stored before the index existed
+    rows = await connection.execute_query_dict(f'SELECT COUNT(*) AS "count" FROM "{BLUEPRINT_NAME_INDEX}"')
+    if rows[0]["count"] == 0:
+        await connection.execute_script(f'INSERT INTO "{BLUEPRINT_NAME_INDEX}"(name) SELECT DISTINCT "name" FROM "blueprint"')
+
+
+async def index_blueprint_name(name: str) -> None:
+    # A single statement, so concurrent workers creating blueprints of the same name can't both insert it
+    await connections.get("default").execute_query(
+        f'INSERT INTO "{BLUEPRINT_NAME_INDEX}"(name) SELECT ? '
+        f'WHERE NOT EXISTS (SELECT 1 FROM "{BLUEPRINT_NAME_INDEX}" WHERE "{BLUEPRINT_NAME_INDEX}" MATCH ? AND name = ?)',
+        [name, quote(name), name],
+    )
+
+
+def score_name(query: str, name: str) -> float:
+    # Similarity of the whole strings, boosted for names that start with or contain the query
+    query, name = query.lower(), name.lower()
+    score = SequenceMatcher(None, query, name).ratio()
+    if name.startswith(query):
+        score += 2
+    elif query in name:
+        score += 1
+    return score
+
+
+async def search_blueprint_names(query: str, limit: int = MAX_MATCHES) -> list[tuple[str, float]]:
+    # Returns up to limit (name, score) pairs, best first: names starting with the query, then names containing it,
+    # then names that are merely similar
+    query = query.strip()
+    connection = connections.get("default")
+    if len(query) < 3:
+        # Too short for a trigram, so this is a LIKE scan; fine for the short queries that get here
+        rows = await connection.execute_query_dict(
+            f'SELECT DISTINCT name FROM "{BLUEPRINT_NAME_INDEX}" WHERE name LIKE ? LIMIT ?', [f"%{query}%", limit * CANDIDATES_PER_MATCH]
+        )
+    else:
+        rows = await connection.execute_query_dict(
+            f'SELECT DISTINCT name FROM "{BLUEPRINT_NAME_INDEX}" WHERE "{BLUEPRINT_NAME_INDEX}" MATCH ? ORDER BY rank LIMIT ?',
+            [quote(query), limit * CANDIDATES_PER_MATCH],
+        )
+        # Any shared trigram makes a candidate; bm25 ranks the names sharing the most first
+        trigram_query = " OR ".join(quote(trigram) for trigram in get_trigrams(query))
+        rows += await connection.execute_query_dict(
+            f'SELECT DISTINCT name FROM "{BLUEPRINT_NAME_INDEX}" WHERE "{BLUEPRINT_NAME_INDEX}" MATCH ? ORDER BY rank LIMIT ?',
+            [trigram_query, limit * CANDIDATES_PER_MATCH],
+        )
+
+    scores = {row["name"]: score_name(query, row["name"]) for row in rows}
+    matches = sorted(((name, score) for name, score in scores.items() if score >= MIN_SIMILARITY), key=lambda match: -match[1])
+    return matches[:limit]
+
+
+async def find_blueprint_names(query: str) -> list[str]:
+    # The names a search for query most likely means. A partial name means every name that contains it, but a typo
+    # only means the closest names, not every name that happens to be similar
+    matches = await search_blueprint_names(query)
+    if not matches:
+        return []
+    if matches[0][1] >= 1:
+        return [name for name, score in matches if score >= 1]
+    return [name for name, score in matches if score == matches[0][1]]
@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+from typing import Any
+
+
+class LookupCache:
+    # Bounded LRU cache of ORM objects, plus a TTL'd record of keys that are known not to exist (e.g. 404s)
+    def __init__(self, max_size: int, negative_ttl: float):
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.entries: OrderedDict[str, Any] = OrderedDict()
+        self.missing: OrderedDict[str, float] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def get(self, key: str) -> Any | None:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        self.missing.pop(key, None)
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def is_missing(self, key: str) -> bool:
+        expires_at = self.missing.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self.missing[key]
+            return False
+
+        self.negative_hits += 1
+        return True
+
+    def put_missing(self, key: str) -> None:
+        self.entries.pop(key, None)
+        self.missing[key] = time.monotonic() + self.negative_ttl
+        self.missing.move_to_end(key)
+        while len(self.missing) > self.max_size:
+            self.missing.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
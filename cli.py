@@ -0,0 +1,164 @@
+import argparse
+import asyncio
+import os
+import sys
+import traceback
+from pathlib import Path
+from tortoise import Tortoise
+
+from db import setup_db, DB_PATH
+from jobs import JOB_TYPES, create_job, describe_job, run_job, run_queued_jobs, resume_job, mark_interrupted_jobs
+from models import Job
+from progress import ProgressReporter, ConsoleProgressReporter
+from response_cache import ResponseCache, RESPONSE_CACHE_DIR
+from searches import Searcher, DEFAULT_PREFETCH_WORKERS
+from time_windows import check_window
+from utils import create_dir_if_not_exist, check_output_format, OUTPUT_FORMATS, SUMMARY_LAYOUTS, DEFAULT_SUMMARY_LAYOUT
+
+DEFAULT_CONCURRENCY = 4
+
+
+def read_targets(args) -> list[str]:
+    targets = list(args.targets)
+    if args.input_file is not None:
+        with open(args.input_file, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    targets.append(line)
+    return targets
+
+
+def get_job_parameters(args, target: str) -> dict:
+    if args.command == "asset":
+        return {"original_asset_name": target, "search_type": args.search_type, "output_format": args.format, "since": args.since, "until": args.until}
+    elif args.command == "user":
+        return {
+            "user_address": target,
+            "output_format": args.format,
+            "get_transfers_out": args.transfers_out,
+            "get_transfers_in": args.transfers_in,
+            "get_mints": args.mints,
+            "get_first_non_mint": args.first_non_mint,
+            "incremental": args.incremental,
+            "since": args.since,
+            "until": args.until,
+            "summary_layout": args.summary_layout,
+        }
+    elif args.command == "prefetch":
+        return {"token_address": target, "starting_token_id": args.start, "ending_token_id": args.end, "num_workers": args.workers, "bulk": args.bulk}
+
+
+async def get_jobs(args) -> list[Job] | None:
+    # The jobs to run now, or None to work through the queue
+    if args.command == "resume":
+        return [await resume_job(job_id) for job_id in args.job_ids]
+    if args.command == "run-queue":
+        return None
+    status = "queued" if args.queue else "running"
+    return [await create_job(args.command, get_job_parameters(args, target), status) for target in read_targets(args)]
+
+
+async def main(args) -> int:
+    if args.command in JOB_TYPES and not read_targets(args):
+        print("Nothing to do: give targets as arguments or with --input-file", file=sys.stderr)
+        return 2
+
+    check_output_format(args.format)
+    if args.command in ("asset", "user"):
+        check_window(args.since, args.until)
+    create_dir_if_not_exist(args.output_dir)
+    await setup_db(args.db)
+    await mark_interrupted_jobs()
+
+    if args.command == "jobs" or args.queue:
+        jobs = await Job.all().order_by("id") if args.command == "jobs" else await get_jobs(args)
+        for job in jobs or []:
+            print(describe_job(job))
+        await Tortoise.close_connections()
+        return 0
+
+    progress = ProgressReporter() if args.quiet else ConsoleProgressReporter()
+    # One searcher for every target, so they share the rate limit, the connection pool and the lookup caches
+    response_cache = ResponseCache(args.response_cache, args.offline) if args.response_cache else None
+    searcher = Searcher(progress, args.test_mode, args.http2, response_cache=response_cache)
+    semaphore = asyncio.Semaphore(max(args.concurrency, 1))
+
+    async def run(job: Job) -> bool:
+        async with semaphore:
+            try:
+                await run_job(searcher, job, args.output_dir, args.profile)
+                return True
+            except Exception:
+                print(f"Job #{job.id} failed:\n{traceback.format_exc()}", file=sys.stderr)
+                return False
+
+    try:
+        jobs = await get_jobs(args)
+        if jobs is None:
+            results = [await run_queued_jobs(searcher, args.output_dir, args.profile) == 0]
+        else:
+            results = await asyncio.gather(*(run(job) for job in jobs))
+        searcher.log_cache_stats()
+    finally:
+        await searcher.close()
+        await Tortoise.close_connections()
+
+    return 0 if all(results) else 1
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Run IMX searches without the Textual UI")
+    parser.add_argument("--output-dir", type=Path, default=Path() / "output")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv")
+    parser.add_argument("--db", default=os.environ.get("IMX_DB_PATH", DB_PATH))
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="How many targets to run at once")
+    parser.add_argument("--test-mode", action="store_true", default=os.environ.get("IMX_TEST_MODE") == "1")
+    parser.add_argument("--http2", action="store_true", default=os.environ.get("IMX_HTTP2") == "1")
+    parser.add_argument("--quiet", action="store_true", help="Only print errors")
+    parser.add_argument("--profile", action="store_true", default=os.environ.get("IMX_PROFILE") == "1", help="Write a cProfile .prof file for each job")
+    parser.add_argument("--response-cache", default=os.environ.get("IMX_RESPONSE_CACHE", RESPONSE_CACHE_DIR), help='Directory of cached API responses; "" turns the cache off')
+    parser.add_argument("--offline", action="store_true", default=os.environ.get("IMX_OFFLINE") == "1", help="Only serve API responses from the response cache")
+    parser.add_argument("--queue", action="store_true", help="Add the jobs to the queue instead of running them")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name: str, target_help: str) -> argparse.ArgumentParser:
+        subparser = subparsers.add_parser(name)
+        subparser.add_argument("targets", nargs="*", help=target_help)
+        subparser.add_argument("--input-file", help="File with one target per line; blank lines and # comments are skipped")
+        return subparser
+
+    def add_window_arguments(subparser: argparse.ArgumentParser, exported: str) -> None:
+        subparser.add_argument("--since", help=f"Only export {exported} from this time on, e.g. 30d, 12h or 2024-01-01")
+        subparser.add_argument("--until", help=f"Only export {exported} before this time, in the same formats as --since")
+
+    asset_parser = add_command("asset", 'Blueprint or metadata names, or trait queries like "rarity=Legendary; token_address=0x..."')
+    asset_parser.add_argument("--search-type", choices=("blueprint", "metadata", "trait"), default="blueprint")
+    add_window_arguments(asset_parser, "transfers")
+
+    user_parser = add_command("user", "User addresses to search for")
+    user_parser.add_argument("--no-transfers-out", dest="transfers_out", action="store_false")
+    user_parser.add_argument("--no-transfers-in", dest="transfers_in", action="store_false")
+    user_parser.add_argument("--no-mints", dest="mints", action="store_false")
+    user_parser.add_argument("--no-first-non-mint", dest="first_non_mint", action="store_false")
+    user_parser.add_argument("--incremental", action="store_true", help="Only fetch records newer than the last search")
+    add_window_arguments(user_parser, "transfers and mints")
+    user_parser.add_argument("--summary-layout", choices=SUMMARY_LAYOUTS, default=DEFAULT_SUMMARY_LAYOUT, help='Shape of the "counts by user" files; sparse suits many users and blueprints')
+
+    prefetch_parser = add_command("prefetch", "Token addresses to prefetch blueprints for")
+    prefetch_parser.add_argument("--start", type=int, default=1, help="First token id")
+    prefetch_parser.add_argument("--end", type=int, default=100, help="Token id to stop before")
+    prefetch_parser.add_argument("--workers", type=int, default=DEFAULT_PREFETCH_WORKERS)
+    prefetch_parser.add_argument("--bulk", action="store_true", help="List the whole collection a page at a time instead of each token id from --start to --end")
+
+    subparsers.add_parser("jobs", help="List jobs and their status")
+    subparsers.add_parser("run-queue", help="Run queued jobs one after another")
+    resume_parser = subparsers.add_parser("resume", help="Resume failed or interrupted jobs from their checkpoints")
+    resume_parser.add_argument("job_ids", nargs="+", type=int)
+
+    return parser
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(get_parser().parse_args())))
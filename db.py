@@ -0,0 +1,129 @@
+from tortoise import Tortoise, connections
+from tortoise.expressions import Subquery
+
+from blueprint_search import create_blueprint_name_index
+from deserializers import create_traits
+from models import Asset, Trait, EXPORT_CHUNK_SIZE
+from utils import to_epoch
+
+DB_PATH = "db.sqlite3"
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # Safe with WAL; a power loss can only drop the most recent commits
+    "cache_size": -64000,  # Negative values are in KiB, so this is ~64MB of page cache
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,  # Milliseconds to wait on a lock held by another process (e.g. a second app)
+}
+# Table -> {epoch column: the text timestamp column it is parsed from}
+EPOCH_COLUMNS = {
+    "asset": {"created_at_epoch": "created_at", "updated_at_epoch": "updated_at"},
+    "transfer": {"timestamp_epoch": "timestamp"},
+    "mint": {"timestamp_epoch": "timestamp"},
+}
+
+
+def get_db_config(db_path: str = DB_PATH, pragmas: dict | None = None) -> dict:
+    # Tortoise runs every credential other than file_path as a PRAGMA when it opens the connection
+    credentials = {"file_path": db_path} | DEFAULT_PRAGMAS | (pragmas or {})
+    return {
+        "connections": {"default": {"engine": "tortoise.backends.sqlite", "credentials": credentials}},
+        "apps": {"models": {"models": ["models"], "default_connection": "default"}},
+    }
+
+
+async def add_unique_transaction_id_index() -> None:
+    # generate_schemas adds new plain indexes to existing tables, but transaction_id's UNIQUE is part of the table
+    # definition, so databases created before it need a unique index added by hand
+    connection = connections.get("default")
+    for index in await connection.execute_query_dict("PRAGMA index_list('transfer')"):
+        if index["unique"]:
+            columns = await connection.execute_query_dict(f"PRAGMA index_info('{index['name']}')")
+            if [column["name"] for column in columns] == ["transaction_id"]:
+                return
+
+    await connection.execute_script(
+        """
+        DELETE FROM "transfer" WHERE "id" NOT IN (SELECT MIN("id") FROM "transfer" GROUP BY "transaction_id");
+        CREATE UNIQUE INDEX IF NOT EXISTS "uid_transfer_transaction_id" ON "transfer" ("transaction_id");
+        """
+    )
+
+
+async def add_epoch_columns() -> None:
+    # generate_schemas only creates missing tables, so tables from before the epoch columns get them here. This runs
+    # before generate_schemas, whose CREATE INDEX statements would fail on the missing columns
+    connection = connections.get("default")
+    for table, columns in EPOCH_COLUMNS.items():
+        existing_columns = {column["name"] for column in await connection.execute_query_dict(f"PRAGMA table_info('{table}')")}
+        if not existing_columns:
+            continue  # A new database, where generate_schemas creates the whole table
+        for column in columns:
+            if column not in existing_columns:
+                await connection.execute_script(f'ALTER TABLE "{table}" ADD COLUMN "{column}" BIGINT')
+
+
+async def backfill_epoch_columns() -> None:
+    # Parses the timestamps of rows stored before the epoch columns existed, a chunk at a time. Rows whose timestamps
+    # can't be parsed stay NULL, so the scan moves forward by rowid rather than repeating until nothing is left
+    connection = connections.get("default")
+    for table, columns in EPOCH_COLUMNS.items():
+        text_columns = ", ".join(f'"{text_column}"' for text_column in columns.values())
+        missing = " OR ".join(f'"{column}" IS NULL' for column in columns)
+        assignments = ", ".join(f'"{column}" = ?' for column in columns)
+        last_rowid = 0
+        while True:
+            rows = await connection.execute_query_dict(
+                f'SELECT rowid AS "row_id", {text_columns} FROM "{table}" WHERE rowid > ? AND ({missing}) ORDER BY rowid LIMIT ?',
+                [last_rowid, EXPORT_CHUNK_SIZE],
+            )
+            if not rows:
+                break
+            await connection.execute_many(
+                f'UPDATE "{table}" SET {assignments} WHERE rowid = ?',
+                [[to_epoch(row[text_column]) for text_column in columns.values()] + [row["row_id"]] for row in rows],
+            )
+            last_rowid = rows[-1]["row_id"]
+
+
+async def backfill_traits() -> None:
+    # Assets stored before the trait table existed get their traits here. Assets with empty metadata never get any
+    # traits, so the scan moves forward by id rather than repeating until nothing is left
+    last_id = ""
+    while True:
+        assets = await (
+            Asset.filter(id__gt=last_id)
+            .exclude(id__in=Subquery(Trait.all().values("asset_id")))
+            .order_by("id")
+            .limit(EXPORT_CHUNK_SIZE)
+        )
+        if not assets:
+            return
+        await create_traits(assets)
+        last_id = assets[-1].id
+
+
+# One-off migrations of databases made by older versions, in the order they were added. SQLite's user_version records
+# how many have run, so each runs once rather than on every start. New ones go on the end
+MIGRATIONS = (add_unique_transaction_id_index, backfill_traits, backfill_epoch_columns)
+
+
+async def get_schema_version() -> int:
+    rows = await connections.get("default").execute_query_dict("PRAGMA user_version")
+    return rows[0]["user_version"]
+
+
+async def run_migrations() -> None:
+    connection = connections.get("default")
+    version = await get_schema_version()
+    for migration in MIGRATIONS[version:]:
+        await migration()
+        version += 1
+        await connection.execute_script(f"PRAGMA user_version = {version}")
+
+
+async def setup_db(db_path: str = DB_PATH, pragmas: dict | None = None) -> None:
+    await Tortoise.init(config=get_db_config(db_path, pragmas))
+    await add_epoch_columns()
+    await Tortoise.generate_schemas()
+    await run_migrations()
+    await create_blueprint_name_index()
@@ -1,24 +1,169 @@
-from models import Asset, Blueprint
+import json
+from tortoise.transactions import in_transaction
 
+from api_models import AssetResponse, TransferResponse, MintResponse
+from models import Asset, Blueprint, Transfer, Mint, Trait
+from utils import to_epoch
 
-async def create_asset(asset_dict: dict):
+
+def get_asset_id(asset_dict: AssetResponse) -> str:
+    return f"{asset_dict['token_address']}-{asset_dict['token_id']}"
+
+
+def get_asset_fields(asset_dict: AssetResponse) -> dict:
     metadata = {} if asset_dict['metadata'] is None else asset_dict['metadata']
-    asset, created = await Asset.get_or_create(
-        id=f"{asset_dict['token_address']}-{asset_dict['token_id']}",
-        defaults=dict(
-            token_address=asset_dict['token_address'],
-            token_id=asset_dict['token_id'],
-            user=asset_dict['user'],
-            status=asset_dict['status'],
-            uri=asset_dict['uri'],
-            name=asset_dict['name'],
-            description=asset_dict['description'],
-            image_url=asset_dict['image_url'],
-            metadata=metadata,
-            collection=asset_dict['collection'],
-            created_at=asset_dict['created_at'],
-            updated_at=asset_dict['updated_at'],
-        )
+    return dict(
+        token_address=asset_dict['token_address'],
+        token_id=asset_dict['token_id'],
+        user=asset_dict['user'],
+        status=asset_dict['status'],
+        uri=asset_dict['uri'],
+        name=asset_dict['name'],
+        description=asset_dict['description'],
+        image_url=asset_dict['image_url'],
+        metadata=metadata,
+        collection=asset_dict['collection'],
+        created_at=asset_dict['created_at'],
+        updated_at=asset_dict['updated_at'],
+        created_at_epoch=to_epoch(asset_dict['created_at']),
+        updated_at_epoch=to_epoch(asset_dict['updated_at']),
+    )
+
+
+# The Asset fields that come from the API, which refresh_assets keeps up to date
+ASSET_API_FIELDS = (
+    "user", "status", "uri", "name", "description", "image_url", "metadata", "collection",
+    "created_at", "updated_at", "created_at_epoch", "updated_at_epoch",
+)
+
+
+def get_transfer_fields(transfer_dict: TransferResponse) -> dict:
+    return dict(
+        receiver=transfer_dict['receiver'],
+        status=transfer_dict['status'],
+        timestamp=transfer_dict['timestamp'],
+        timestamp_epoch=to_epoch(transfer_dict['timestamp']),
+        user=transfer_dict['user'],
+    )
+
+
+def get_mint_fields(mint_dict: MintResponse) -> dict:
+    return dict(
+        status=mint_dict['status'],
+        timestamp=mint_dict['timestamp'],
+        timestamp_epoch=to_epoch(mint_dict['timestamp']),
+        user=mint_dict['user'],
     )
 
-    return asset
\ No newline at end of file
+
+def flatten_metadata(metadata: dict, prefix: str = "") -> list[tuple[str, str]]:
+    # Nested objects become dotted keys and lists become one trait per item. Values are stored as text, with
+    # non-strings JSON encoded so that e.g. True is "true" and 5 is "5"
+    traits = []
+    for key, value in metadata.items():
+        key = f"{prefix}{key}"
+        if isinstance(value, dict):
+            traits += flatten_metadata(value, f"{key}.")
+            continue
+        for item in value if isinstance(value, list) else [value]:
+            if item is None or isinstance(item, (dict, list)):
+                continue
+            traits.append((key, item if isinstance(item, str) else json.dumps(item)))
+    return traits
+
+
+async def create_traits(assets: list[Asset]) -> None:
+    traits = {}
+    for asset in assets:
+        for key, value in flatten_metadata(asset.metadata or {}):
+            traits[(asset.id, key, value)] = Trait(asset_id=asset.id, token_address=asset.token_address, key=key, value=value)
+
+    if traits:
+        async with in_transaction():
+            await Trait.bulk_create(traits.values(), ignore_conflicts=True)
+
+
+async def create_asset(asset_dict: AssetResponse) -> Asset:
+    return (await create_assets([asset_dict]))[0]
+
+
+async def refresh_assets(assets: list[Asset], asset_dicts: list[AssetResponse]) -> None:
+    # Brings stored assets up to date with the API's, e.g. a new owner after a trade, writing only the ones that
+    # changed. Assets whose metadata changed get their traits rebuilt
+    changed_assets = []
+    changed_metadata = []
+    for asset, asset_dict in zip(assets, asset_dicts):
+        fields = get_asset_fields(asset_dict)
+        if all(getattr(asset, field) == value for field, value in fields.items()):
+            continue
+        if asset.metadata != fields['metadata']:
+            changed_metadata.append(asset)
+        asset.update_from_dict(fields)
+        changed_assets.append(asset)
+
+    if changed_assets:
+        async with in_transaction():
+            await Asset.bulk_update(changed_assets, fields=list(ASSET_API_FIELDS))
+            if changed_metadata:
+                await Trait.filter(asset_id__in=[asset.id for asset in changed_metadata]).delete()
+        await create_traits(changed_metadata)
+
+
+async def create_assets(asset_dicts: list[AssetResponse]) -> list[Asset]:
+    # Upserts a page of assets: one lookup for the whole page, one insert for whatever is new, and one update for the
+    # stored assets that changed
+    asset_ids = [get_asset_id(asset_dict) for asset_dict in asset_dicts]
+    existing_assets = {asset.id: asset for asset in await Asset.filter(id__in=asset_ids)}
+
+    new_assets: dict[str, Asset] = {}
+    latest_dicts: dict[str, AssetResponse] = {}
+    for asset_id, asset_dict in zip(asset_ids, asset_dicts):
+        latest_dicts[asset_id] = asset_dict
+        if asset_id not in existing_assets and asset_id not in new_assets:
+            new_assets[asset_id] = Asset(id=asset_id, **get_asset_fields(asset_dict))
+
+    stale_ids = [asset_id for asset_id in latest_dicts if asset_id in existing_assets]
+    await refresh_assets([existing_assets[asset_id] for asset_id in stale_ids], [latest_dicts[asset_id] for asset_id in stale_ids])
+
+    if new_assets:
+        async with in_transaction():
+            await Asset.bulk_create(new_assets.values(), ignore_conflicts=True)
+        await create_traits(list(new_assets.values()))
+        # Bulk created objects are not marked as saved, so later .save() calls would try to insert them again
+        existing_assets |= {asset.id: asset for asset in await Asset.filter(id__in=list(new_assets))}
+
+    return [existing_assets[asset_id] for asset_id in asset_ids]
+
+
+async def create_by_transaction_id(model, record_dicts: list[TransferResponse] | list[MintResponse], assets: list[Asset | None], get_fields) -> list:
+    # assets lines up with record_dicts; records of assets that could not be found are skipped
+    transaction_ids = [record_dict['transaction_id'] for record_dict in record_dicts]
+    existing_ids = set(await model.filter(transaction_id__in=transaction_ids).values_list('transaction_id', flat=True))
+
+    new_records = {}
+    for record_dict, asset in zip(record_dicts, assets):
+        transaction_id = record_dict['transaction_id']
+        if asset is not None and transaction_id not in existing_ids and transaction_id not in new_records:
+            new_records[transaction_id] = model(
+                transaction_id=transaction_id,
+                asset_id=asset.id,
+                **get_fields(record_dict)
+            )
+
+    if new_records:
+        async with in_transaction():
+            await model.bulk_create(new_records.values(), ignore_conflicts=True)
+
+    # bulk_create does not populate IntField primary keys, so read the page back
+    records = {}
+    for record in await model.filter(transaction_id__in=transaction_ids):
+        records.setdefault(record.transaction_id, record)
+    return [records[transaction_id] for transaction_id in transaction_ids if transaction_id in records]
+
+
+async def create_transfers(transfer_dicts: list[TransferResponse], assets: list[Asset | None]) -> list[Transfer]:
+    return await create_by_transaction_id(Transfer, transfer_dicts, assets, get_transfer_fields)
+
+
+async def create_mints(mint_dicts: list[MintResponse], assets: list[Asset | None]) -> list[Mint]:
+    return await create_by_transaction_id(Mint, mint_dicts, assets, get_mint_fields)
@@ -0,0 +1,148 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+FAKE_TOKEN_ADDRESS = "0xfake000000000000000000000000000000000001"
+MAX_PAGE_SIZE = 200
+START_TIME = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+
+def format_timestamp(value: datetime) -> str:
+    return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class FakeImxApi(httpx.AsyncBaseTransport):
+    # A deterministic stand-in for the parts of the IMX API that Searcher uses, to pass to Searcher(transport=...).
+    # Token i was minted by one user and then passed along transfers_per_token more users, so every transfer
+    # history chains back from the asset's current owner the way get_transfer_history_of_asset expects
+    def __init__(
+        self,
+        num_tokens: int = 500,
+        num_users: int = 50,
+        transfers_per_token: int = 3,
+        num_names: int = 10,
+        latency: float = 0.0,
+        max_page_size: int = MAX_PAGE_SIZE,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.error_rate = error_rate  # Share of requests answered with a 429
+        self.random = random.Random(seed)
+        self.num_requests = 0
+        self.num_errors = 0
+
+        self.users = [f"0x{user:040x}" for user in range(1, num_users + 1)]
+        self.assets: dict[int, dict] = {}
+        self.mintable_tokens: dict[int, dict] = {}
+        self.transfers: list[dict] = []
+        self.mints: list[dict] = []
+
+        for token_id in range(1, num_tokens + 1):
+            holders = [self.users[(token_id + step * 7) % num_users] for step in range(transfers_per_token + 1)]
+            minted_at = START_TIME + timedelta(minutes=token_id)
+            name = f"Card {token_id % num_names}"
+
+            self.mints.append({
+                "transaction_id": token_id * 1000,
+                "status": "success",
+                "user": holders[0],
+                "timestamp": format_timestamp(minted_at),
+                "token": self.get_token(token_id),
+            })
+            for step in range(1, transfers_per_token + 1):
+                self.transfers.append({
+                    "transaction_id": token_id * 1000 + step,
+                    "status": "success",
+                    "user": holders[step - 1],
+                    "receiver": holders[step],
+                    "timestamp": format_timestamp(minted_at + timedelta(days=step)),
+                    "token": self.get_token(token_id),
+                })
+
+            self.assets[token_id] = {
+                "token_address": FAKE_TOKEN_ADDRESS,
+                "token_id": str(token_id),
+                "id": f"0x{token_id:064x}",
+                "user": holders[-1],
+                "status": "imx",
+                "uri": None,
+                "name": name,
+                "description": None,
+                "image_url": f"https://example.com/{token_id}.png",
+                "metadata": {"name": name, "rarity": ["Common", "Rare", "Epic"][token_id % 3], "edition": token_id},
+                "collection": {"name": "Fake collection", "icon_url": None},
+                "created_at": format_timestamp(minted_at),
+                "updated_at": format_timestamp(minted_at + timedelta(days=transfers_per_token)),
+            }
+            self.mintable_tokens[token_id] = {
+                "token_id": str(token_id),
+                "client_token_id": str(token_id),
+                "token_address": FAKE_TOKEN_ADDRESS,
+                "blueprint": f"Blueprint {token_id % num_names},{token_id}",
+            }
+
+    @staticmethod
+    def get_token(token_id: int) -> dict:
+        return {"type": "ERC721", "data": {"token_address": FAKE_TOKEN_ADDRESS, "token_id": str(token_id)}}
+
+    def get_page(self, records: list[dict], params: httpx.QueryParams) -> dict:
+        if "min_timestamp" in params:
+            records = [record for record in records if record["timestamp"] >= params["min_timestamp"]]
+        records = sorted(records, key=lambda record: record.get("transaction_id", 0), reverse=params.get("direction", "desc") == "desc")
+
+        page_size = min(int(params.get("page_size", 100)), self.max_page_size)
+        offset = int(params.get("cursor", 0))
+        page = records[offset:offset + page_size]
+        next_offset = offset + len(page)
+        return {"result": page, "cursor": str(next_offset), "remaining": int(next_offset < len(records))}
+
+    def get_token_id(self, token_address: str, token_id: str) -> int | None:
+        if token_address != FAKE_TOKEN_ADDRESS or not token_id.isdigit() or int(token_id) not in self.assets:
+            return None
+        return int(token_id)
+
+    def route(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix("/v1").strip("/").split("/")
+        params = request.url.params
+
+        if path == ["assets"]:
+            assets = [asset for asset in self.assets.values()
+                      if params.get("name", asset["name"]) == asset["name"]
+                      and params.get("collection", asset["token_address"]) == asset["token_address"]]
+            return httpx.Response(200, json=self.get_page(assets, params))
+
+        if len(path) == 3 and path[0] in ("assets", "mintable-token"):
+            token_id = self.get_token_id(path[1], path[2])
+            if token_id is None:
+                return httpx.Response(404, json={"code": "resource_not_found", "message": "Not found"})
+            records = self.assets if path[0] == "assets" else self.mintable_tokens
+            return httpx.Response(200, json=records[token_id])
+
+        if path == ["transfers"]:
+            transfers = [transfer for transfer in self.transfers
+                         if params.get("user", transfer["user"]) == transfer["user"]
+                         and params.get("receiver", transfer["receiver"]) == transfer["receiver"]
+                         and params.get("token_id", transfer["token"]["data"].get("token_id")) == transfer["token"]["data"].get("token_id")]
+            return httpx.Response(200, json=self.get_page(transfers, params))
+
+        if path == ["mints"]:
+            mints = [mint for mint in self.mints if params.get("user", mint["user"]) == mint["user"]]
+            return httpx.Response(200, json=self.get_page(mints, params))
+
+        return httpx.Response(404, json={"code": "not_found", "message": f"No fake for {request.url.path}"})
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.num_requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.num_errors += 1
+            return httpx.Response(429, json={"code": "too_many_requests"}, request=request)
+
+        response = self.route(request)
+        response.request = request
+        return response
@@ -0,0 +1,261 @@
+import asyncio
+import cProfile
+import sys
+import traceback
+from contextlib import asynccontextmanager, aclosing
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+
+from metrics import Metrics, current_metrics
+from lineage import iterate_holder_chains, HOLDER_CHAIN_COLUMNS
+from models import Asset, Transfer, Job
+from searches import Searcher, DEFAULT_PREFETCH_WORKERS
+from time_windows import describe_window, get_user_transfers_in_window, get_minted_assets_in_window, iterate_asset_transfers_in_window
+from traits import parse_trait_query, get_trait_counts
+from utils import DEFAULT_SUMMARY_LAYOUT, check_summary_layout, create_transfer_output_files_from_pages, write_rows, iterate_page_rows, iterate_objects_by_id, iterate_list, get_output_path, write_dataframe, write_dataframe_pages
+
+DEFAULT_ASSET_NAME = "#100 Todd McFarlane Batman"
+DEFAULT_USER_ADDRESS = "0x7be178ba43a9828c22997a3ec3640497d88d2fd3"
+
+
+def get_file_prefix(name: str) -> str:
+    return f'{datetime.now().strftime("%Y%m%d_%H%M")} {name}'
+
+
+async def drain(pages) -> None:
+    # Runs a search's pages to the end without keeping them, e.g. when only what it stored is exported
+    async with aclosing(pages) as pages:
+        async for _ in pages:
+            pass
+
+
+@asynccontextmanager
+async def track_job(searcher: Searcher, output_dir: Path | None, file_prefix: str, profile: bool = False):
+    # Everything the job records goes into its own Metrics, which is written next to its outputs as
+    # "<prefix> metrics.json". With profile, the job also runs under cProfile and writes "<prefix> profile.prof"
+    metrics = Metrics(file_prefix)
+    token = current_metrics.set(metrics)
+    cache_stats_before = searcher.get_cache_stats()
+    searcher.progress.watch_metrics(metrics)
+
+    profiler = None
+    if profile:
+        if sys.getprofile() is None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            searcher.send_to_log("Another job is already being profiled, so this one is not")
+
+    try:
+        yield metrics
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        metrics.finish()
+        metrics.set_cache_stats(cache_stats_before, searcher.get_cache_stats())
+        current_metrics.reset(token)
+        searcher.progress.unwatch_metrics(metrics)
+
+        if output_dir is not None:
+            metrics.write_json(output_dir / f"{file_prefix} metrics.json")
+            if profiler is not None:
+                profiler.dump_stats(output_dir / f"{file_prefix} profile.prof")
+
+
+async def run_asset_search(
+    searcher: Searcher,
+    original_asset_name: str,
+    search_type: str | None,
+    output_dir: Path,
+    output_format: str = "csv",
+    profile: bool = False,
+    since: str | None = None,  # since and until limit the exported transfers to a time window; see time_windows
+    until: str | None = None,
+) -> None:
+    if search_type == "metadata":
+        asset_name = original_asset_name.replace(" ", "_")
+    else:
+        asset_name = original_asset_name
+
+    file_prefix = get_file_prefix(original_asset_name)
+    async with track_job(searcher, output_dir, file_prefix, profile):
+        searcher.send_to_log(f"Getting asset data for {original_asset_name}")
+
+        # The assets file is written a page at a time as the search goes. Only the ids of the assets and transfers are
+        # kept, and the other files are written from the database a chunk at a time
+        asset_ids: dict[str, None] = {}
+        transfer_ids: list[int] = []
+
+        async def iterate_asset_pages():
+            async with aclosing(searcher.iterate_asset_search(asset_name, search_type)) as pages:
+                async for page_assets, page_transfers in pages:
+                    asset_ids.update(dict.fromkeys(asset.id for asset in page_assets))
+                    transfer_ids.extend(transfer.id for transfer in page_transfers)
+                    yield page_assets
+
+        await write_rows(get_output_path(output_dir, f"{file_prefix} assets", output_format), iterate_page_rows(iterate_asset_pages()), Asset, output_format)
+
+        searcher.send_to_log(f"Data collected, creating outputs")
+
+        sorted_asset_ids = sorted(asset_ids)
+        if since or until:
+            searcher.send_to_log(f"Exporting transfers {describe_window(since, until)}")
+            transfer_pages = iterate_asset_transfers_in_window(sorted_asset_ids, since, until)
+        else:
+            transfer_pages = iterate_objects_by_id(Transfer, transfer_ids)
+        await write_rows(get_output_path(output_dir, f"{file_prefix} transfers", output_format), iterate_page_rows(transfer_pages), Transfer, output_format)
+        holder_chains_path = get_output_path(output_dir, f"{file_prefix} holder chains", output_format)
+        await write_dataframe_pages(iterate_holder_chains(sorted_asset_ids), holder_chains_path, output_format, HOLDER_CHAIN_COLUMNS)
+
+        if search_type == "trait":
+            # How rare each trait value is in the searched collection (or every stored asset if none was given)
+            _, token_address = parse_trait_query(asset_name)
+            trait_counts = pd.DataFrame(await get_trait_counts(token_address), columns=["key", "value", "count", "share"])
+            write_dataframe(trait_counts, get_output_path(output_dir, f"{file_prefix} trait counts", output_format), output_format)
+
+    searcher.send_to_log(f"Job complete")
+
+
+async def run_user_search(
+    searcher: Searcher,
+    user_address: str,
+    output_dir: Path,
+    output_format: str = "csv",
+    get_transfers_out: bool = True,
+    get_transfers_in: bool = True,
+    get_mints: bool = True,
+    get_first_non_mint: bool = True,
+    incremental: bool = False,
+    profile: bool = False,
+    job: Job | None = None,
+    since: str | None = None,  # since and until limit the exported transfers and mints to a time window
+    until: str | None = None,
+    summary_layout: str = DEFAULT_SUMMARY_LAYOUT,  # Shape of the "counts by user" files; see utils.SUMMARY_LAYOUTS
+) -> None:
+    check_summary_layout(summary_layout)  # Fails before the search rather than after it
+    file_prefix = get_file_prefix(user_address)
+    windowed = bool(since or until)
+    if windowed:
+        searcher.send_to_log(f"Exporting transfers and mints {describe_window(since, until)}")
+
+    # Outputs are written a page at a time as the searches go, apart from windowed ones, which are read from the
+    # database once everything is stored
+    async with track_job(searcher, output_dir, file_prefix, profile):
+        for direction, get_transfers in (("out", get_transfers_out), ("in", get_transfers_in)):
+            if not get_transfers:
+                continue
+            transfer_pages = searcher.iterate_transfer_history_of_user(user_address, direction, get_first_non_mint, incremental, job)
+            if windowed:
+                await drain(transfer_pages)
+                transfer_pages = iterate_list([await get_user_transfers_in_window(user_address, direction, since, until)])
+            await create_transfer_output_files_from_pages(transfer_pages, direction, output_dir, file_prefix, output_format, summary_layout)
+
+        if get_mints:
+            mint_pages = searcher.iterate_minted_assets(user_address, get_first_non_mint, incremental, job)
+            if windowed:
+                await drain(mint_pages)
+                mint_pages = iterate_list([await get_minted_assets_in_window(user_address, since, until)])
+            await write_rows(get_output_path(output_dir, f"{file_prefix} minted assets", output_format), iterate_page_rows(mint_pages), Asset, output_format)
+
+    searcher.send_to_log(f"Job complete")
+
+
+async def run_blueprint_prefetch(
+    searcher: Searcher,
+    token_address: str,
+    starting_token_id: int,
+    ending_token_id: int,
+    num_workers: int = DEFAULT_PREFETCH_WORKERS,
+    output_dir: Path | None = None,
+    profile: bool = False,
+    job: Job | None = None,
+    bulk: bool = False,  # Lists the whole collection instead of looking up each token id; the token ids are ignored
+) -> None:
+    async with track_job(searcher, output_dir, get_file_prefix(f"prefetch {token_address}"), profile):
+        searcher.send_to_log(f"Prefetching blueprints")
+        if bulk:
+            await searcher.collection_prefetch(token_address, num_workers, job)
+        else:
+            await searcher.blueprint_prefetch(token_address, starting_token_id, ending_token_id, num_workers, job)
+    searcher.send_to_log(f"Job complete")
+
+
+# Job type -> the function that runs it. Job.parameters are its keyword arguments, apart from the searcher, output_dir,
+# profile and job, which are given when the job runs
+JOB_FUNCTIONS = {
+    "asset": run_asset_search,
+    "user": run_user_search,
+    "prefetch": run_blueprint_prefetch,
+}
+JOB_TYPES = tuple(JOB_FUNCTIONS)
+RESUMABLE_STATUSES = ("queued", "failed", "interrupted")
+
+
+async def create_job(job_type: str, parameters: dict, status: str = "queued") -> Job:
+    # Jobs that are about to be run straight away are created as running, so a job queue running alongside can't
+    # pick them up as well
+    if job_type not in JOB_FUNCTIONS:
+        raise ValueError(f"Unknown job type {job_type}; expected one of {JOB_TYPES}")
+    return await Job.create(type=job_type, parameters=parameters, status=status)
+
+
+def describe_job(job: Job) -> str:
+    parameters = ", ".join(f"{key}={value}" for key, value in job.parameters.items())
+    checkpoint = f" (checkpoint: {', '.join(sorted(job.checkpoint))})" if job.checkpoint else ""
+    return f"#{job.id} {job.type} [{job.status}] {parameters}{checkpoint}"
+
+
+async def run_job(searcher: Searcher, job: Job, output_dir: Path, profile: bool = False) -> None:
+    job.status = "running"
+    job.error = None
+    await job.save()
+    searcher.send_to_log(f"Running {describe_job(job)}")
+
+    job_function = JOB_FUNCTIONS[job.type]
+    arguments = dict(job.parameters, output_dir=output_dir, profile=profile)
+    if job.type != "asset":  # Asset searches have no checkpoints, and rerun from the start
+        arguments["job"] = job
+
+    try:
+        await job_function(searcher, **arguments)
+    except asyncio.CancelledError:
+        job.status = "interrupted"
+        await job.save()
+        raise
+    except Exception:
+        job.status = "failed"
+        job.error = traceback.format_exc()
+        await job.save()
+        raise
+
+    job.status = "complete"
+    await job.save()
+
+
+async def run_queued_jobs(searcher: Searcher, output_dir: Path, profile: bool = False) -> int:
+    # Runs queued jobs one after another, oldest first, including any queued while this runs. A failed job is logged
+    # and left to be resumed. Returns how many failed
+    num_failed = 0
+    while (job := await Job.filter(status="queued").order_by("id").first()) is not None:
+        try:
+            await run_job(searcher, job, output_dir, profile)
+        except Exception:
+            searcher.send_to_log(f"Job #{job.id} failed:\n{job.error}")
+            num_failed += 1
+    return num_failed
+
+
+async def resume_job(job_id: int) -> Job:
+    # Queues a job again; it picks up from its checkpoint when it runs
+    job = await Job.get(id=job_id)
+    if job.status not in RESUMABLE_STATUSES:
+        raise ValueError(f"Job #{job_id} is {job.status}; only {', '.join(RESUMABLE_STATUSES)} jobs can be resumed")
+    job.status = "queued"
+    await job.save()
+    return job
+
+
+async def mark_interrupted_jobs() -> None:
+    # Jobs still marked running when the app starts were stopped by a crash or quit
+    await Job.filter(status="running").update(status="interrupted")
@@ -0,0 +1,146 @@
+from datetime import datetime, timezone
+
+import pandas as pd
+from tortoise import connections
+
+from models import Asset, Mint, EXPORT_CHUNK_SIZE
+
+# Every stored transfer of the chunk's assets in order, with the transfer that follows it. In a complete history each
+# transfer's receiver is the user who sends the next one. Ordered by the epoch column, as text timestamps written with
+# different precision don't sort in time order
+CHAIN_QUERY = """
+SELECT "asset_id", "user", "receiver", "timestamp", "transaction_id",
+    ROW_NUMBER() OVER holdings AS "position",
+    LEAD("user") OVER holdings AS "next_user",
+    LEAD("timestamp") OVER holdings AS "released_at"
+FROM "transfer"
+WHERE "asset_id" IN ({placeholders})
+WINDOW holdings AS (PARTITION BY "asset_id" ORDER BY "timestamp_epoch", "transaction_id")
+"""
+
+LINEAGE_QUERY = f"""
+WITH chain AS ({CHAIN_QUERY})
+SELECT "asset_id",
+    COUNT(*) AS "num_transfers",
+    SUM("next_user" IS NOT NULL AND "next_user" != "receiver") AS "num_breaks",
+    MAX(CASE WHEN "position" = 1 THEN "user" END) AS "mint_address",
+    MAX(CASE WHEN "position" = 1 THEN "receiver" END) AS "first_non_mint_address",
+    MAX(CASE WHEN "next_user" IS NULL THEN "receiver" END) AS "last_receiver"
+FROM chain
+GROUP BY "asset_id"
+"""
+
+# Parquet types of the get_holder_chains columns, for writing them a chunk at a time
+HOLDER_CHAIN_COLUMNS = {
+    "asset_id": "string",
+    "position": "int",
+    "holder": "string",
+    "acquired_at": "timestamp",
+    "released_at": "timestamp",
+    "hold_seconds": "float",
+}
+
+LINEAGE_FIELDS = ("mint_address", "first_non_mint_address", "num_transfers", "checked_first_non_mint_address")
+
+
+async def query_by_asset_ids(query: str, asset_ids: list[str]) -> list[dict]:
+    rows = []
+    connection = connections.get("default")
+    for start in range(0, len(asset_ids), EXPORT_CHUNK_SIZE):
+        chunk = asset_ids[start:start + EXPORT_CHUNK_SIZE]
+        rows += await connection.execute_query_dict(query.format(placeholders=", ".join(["?"] * len(chunk))), chunk)
+    return rows
+
+
+async def get_minters(asset_ids: list[str]) -> dict[str, dict]:
+    minters = {}
+    for start in range(0, len(asset_ids), EXPORT_CHUNK_SIZE):
+        for mint in await Mint.filter(asset_id__in=asset_ids[start:start + EXPORT_CHUNK_SIZE]).values("asset_id", "user", "timestamp"):
+            minters[mint["asset_id"]] = mint
+    return minters
+
+
+def get_local_lineage(asset: Asset, lineage: dict | None, minter: dict | None) -> dict | None:
+    # The lineage fields from the stored transfers, or None if they might not be the asset's whole history. The chain
+    # has to be unbroken and end with the asset's owner, and has to start with its minter, known either from a stored
+    # mint or from an earlier API walk that counted the same number of transfers
+    if lineage is None:
+        lineage = {"num_transfers": 0, "num_breaks": 0, "mint_address": asset.user, "first_non_mint_address": None, "last_receiver": asset.user}
+
+    if lineage["num_breaks"] or lineage["last_receiver"] != asset.user:
+        return None
+    minted_by_first_sender = minter is not None and minter["user"] == lineage["mint_address"]
+    counted_before = asset.checked_first_non_mint_address and asset.num_transfers == lineage["num_transfers"]
+    if not (minted_by_first_sender or counted_before):
+        return None
+
+    return {
+        "mint_address": lineage["mint_address"],
+        "first_non_mint_address": lineage["first_non_mint_address"],
+        "num_transfers": lineage["num_transfers"],
+        "checked_first_non_mint_address": True,
+    }
+
+
+async def get_local_lineages(assets: list[Asset]) -> dict[str, dict]:
+    # Asset id -> lineage fields for every asset whose stored history looks complete, in one query per chunk of assets.
+    # Whether the API has transfers newer than the stored ones is up to the caller to check
+    asset_ids = [asset.id for asset in assets]
+    lineages = {row["asset_id"]: row for row in await query_by_asset_ids(LINEAGE_QUERY, asset_ids)}
+    minters = await get_minters(asset_ids)
+
+    local_lineages = {}
+    for asset in assets:
+        local_lineage = get_local_lineage(asset, lineages.get(asset.id), minters.get(asset.id))
+        if local_lineage is not None:
+            local_lineages[asset.id] = local_lineage
+    return local_lineages
+
+
+async def save_lineages(assets: list[Asset], lineages: dict[str, dict]) -> None:
+    # Sets and saves the given lineage fields of the assets, leaving their other fields as stored
+    resolved = []
+    for asset in assets:
+        if asset.id in lineages:
+            asset.update_from_dict(lineages[asset.id])
+            resolved.append(asset)
+    if resolved:
+        await Asset.bulk_update(resolved, fields=list(LINEAGE_FIELDS), batch_size=EXPORT_CHUNK_SIZE)
+
+
+async def get_holder_chains(assets: list[Asset]) -> pd.DataFrame:
+    # One row per holding of each asset, from its minter to its current owner, with how long it was held. The minter's
+    # holding starts at the mint if that is stored. Current holdings have no released_at and are held until now
+    assets = list({asset.id: asset for asset in assets}.values())
+    asset_ids = [asset.id for asset in assets]
+    chain = pd.DataFrame(
+        await query_by_asset_ids(CHAIN_QUERY, asset_ids),
+        columns=["asset_id", "user", "receiver", "timestamp", "transaction_id", "position", "next_user", "released_at"],
+    )
+    holdings = chain.rename(columns={"receiver": "holder", "timestamp": "acquired_at"})[["asset_id", "position", "holder", "acquired_at", "released_at"]]
+
+    minters = await get_minters(asset_ids)
+    first_transfers = chain[chain["position"] == 1].set_index("asset_id")
+    minter_holdings = pd.DataFrame([
+        {
+            "asset_id": asset.id,
+            "position": 0,
+            "holder": first_transfers.at[asset.id, "user"] if asset.id in first_transfers.index else asset.user,
+            "acquired_at": minters[asset.id]["timestamp"] if asset.id in minters else None,
+            "released_at": first_transfers.at[asset.id, "timestamp"] if asset.id in first_transfers.index else None,
+        }
+        for asset in assets
+    ], columns=holdings.columns)
+
+    holdings = pd.concat([minter_holdings, holdings], ignore_index=True).sort_values(["asset_id", "position"], ignore_index=True)
+    acquired_at = pd.to_datetime(holdings["acquired_at"], utc=True)
+    released_at = pd.to_datetime(holdings["released_at"], utc=True).fillna(pd.Timestamp(datetime.now(timezone.utc)))
+    holdings["hold_seconds"] = (released_at - acquired_at).dt.total_seconds()
+    return holdings
+
+
+async def iterate_holder_chains(asset_ids: list[str]):
+    # get_holder_chains for a chunk of the assets at a time, loaded by id. With sorted ids, the chunks follow on from
+    # each other in the same order as one call for all of them
+    for start in range(0, len(asset_ids), EXPORT_CHUNK_SIZE):
+        yield await get_holder_chains(await Asset.filter(id__in=asset_ids[start:start + EXPORT_CHUNK_SIZE]))
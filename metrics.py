@@ -0,0 +1,163 @@
+import json
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterable, AsyncIterator
+
+import httpx
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Upper bounds in seconds; slower requests go in one more bucket
+
+
+def get_endpoint(url) -> str:
+    # Groups requests by route, so /assets/0xabc/1 and /assets/0xdef/2 are both /assets/{}/{}
+    segments = httpx.URL(str(url)).path.removeprefix("/v1").strip("/").split("/")
+    return "/" + "/".join(segments[:1] + ["{}"] * (len(segments) - 1))
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.bucket_counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        # The upper bound of the bucket the percentile falls in, so it overestimates by at most one bucket
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        bucket_names = [f"<={bound}" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}"]
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": self.max,
+            "buckets": dict(zip(bucket_names, self.bucket_counts)),
+        }
+
+
+class Metrics:
+    # Timings and counters for one job. Searcher and the exporters in utils record into get_metrics(), which is the
+    # Metrics of the job running in the current asyncio context
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.start_time = time.monotonic()
+        self.end_time: float | None = None
+        self.latencies: dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.status_codes: Counter = Counter()
+        self.retries: Counter = Counter()
+        self.backoff_seconds = 0.0
+        self.cached_responses = 0
+        # Time spent awaiting each section. Concurrent workers overlap, so this can add up to more than the wall time
+        self.section_seconds: dict[str, float] = defaultdict(float)
+        self.section_rows: Counter = Counter()
+        self.caches: dict[str, dict] = {}
+
+    def record_request(self, url, status_code: int, seconds: float) -> None:
+        self.latencies[get_endpoint(url)].add(seconds)
+        self.status_codes[status_code] += 1
+
+    def record_retry(self, status_code: int, backoff_seconds: float) -> None:
+        self.retries[status_code] += 1
+        self.backoff_seconds += backoff_seconds
+
+    def record_cached_response(self) -> None:
+        self.cached_responses += 1
+
+    @contextmanager
+    def timed(self, section: str, rows: int = 0):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.section_seconds[section] += time.perf_counter() - start_time
+            self.section_rows[section] += rows
+
+    async def count_rows(self, section: str, rows: AsyncIterable) -> AsyncIterator:
+        # Used inside timed(section). Time spent waiting for the next row belongs to whatever produces the rows (e.g. a
+        # search streaming its pages), so it is taken back off the section
+        rows = aiter(rows)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                row = await anext(rows)
+            except StopAsyncIteration:
+                return
+            finally:
+                self.section_seconds[section] -= time.perf_counter() - start_time
+            self.section_rows[section] += 1
+            yield row
+
+    def set_cache_stats(self, before: dict[str, dict], after: dict[str, dict]) -> None:
+        # The caches live as long as the searcher, so a job's share is the difference over its run
+        for name, stats in after.items():
+            job_stats = {key: value - before[name].get(key, 0) for key, value in stats.items() if key != "hit_rate"}
+            lookups = job_stats["hits"] + job_stats["misses"]
+            self.caches[name] = job_stats | {"hit_rate": job_stats["hits"] / lookups if lookups else 0.0}
+
+    def finish(self) -> None:
+        self.end_time = time.monotonic()
+
+    def get_seconds(self) -> float:
+        return (self.end_time or time.monotonic()) - self.start_time
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "seconds": self.get_seconds(),
+            "requests": sum(self.status_codes.values()),
+            "status_codes": {str(status_code): count for status_code, count in sorted(self.status_codes.items())},
+            "latency_by_endpoint": {endpoint: histogram.to_dict() for endpoint, histogram in sorted(self.latencies.items())},
+            "retries": {str(status_code): count for status_code, count in sorted(self.retries.items())},
+            "backoff_seconds": self.backoff_seconds,
+            "cached_responses": self.cached_responses,
+            "sections": {
+                section: {
+                    "seconds": seconds,
+                    "rows": self.section_rows[section],
+                    "rows_per_second": self.section_rows[section] / seconds if seconds else 0.0,
+                }
+                for section, seconds in sorted(self.section_seconds.items())
+            },
+            "caches": self.caches,
+        }
+
+    def write_json(self, path) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary_lines(self) -> list[str]:
+        summary = self.to_dict()
+        lines = [f"{self.name}: {summary['seconds']:.1f}s, {summary['requests']} requests, {self.cached_responses} from cache"]
+        for endpoint, latency in summary["latency_by_endpoint"].items():
+            lines.append(f"{endpoint}: {latency['count']} requests, mean {latency['mean']:.2f}s, p95 {latency['p95']:.2f}s, max {latency['max']:.2f}s")
+        if self.retries:
+            retries = ", ".join(f"{count} x {status_code}" for status_code, count in summary["retries"].items())
+            lines.append(f"Retries: {retries}, {self.backoff_seconds:.1f}s backing off")
+        for section, stats in summary["sections"].items():
+            lines.append(f"{section}: {stats['seconds']:.1f}s, {stats['rows']} rows ({stats['rows_per_second']:.0f} rows/s)")
+        for name, stats in self.caches.items():
+            lines.append(f"{name} cache: {stats['hit_rate']:.0%} hit rate")
+        return lines
+
+
+current_metrics: ContextVar[Metrics] = ContextVar("current_metrics", default=Metrics("untracked"))
+
+
+def get_metrics() -> Metrics:
+    return current_metrics.get()
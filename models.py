@@ -1,6 +1,8 @@
 from tortoise.models import Model
 from tortoise import fields
 
+EXPORT_CHUNK_SIZE = 5000  # Keeps the IN (...) lists of the related object queries under SQLite's variable limit
+
 
 def get_blueprint_data(blueprint):
     try:
@@ -26,6 +28,9 @@ class Blueprint(Model):
     token_address = fields.TextField()
     token_id = fields.TextField()
 
+    class Meta:
+        indexes = (("name",),)
+
     def __str__(self):
         return self.blueprint
 
@@ -44,7 +49,10 @@ class Asset(Model):
     collection = fields.JSONField(null=True)
     created_at = fields.TextField()
     updated_at = fields.TextField()
-    blueprint: fields.ForeignKeyRelation[Blueprint] = fields.ForeignKeyField("models.Blueprint", related_name="assets", null=True)
+    # The text timestamps in microseconds since the Unix epoch, so time ranges are indexed integer comparisons
+    created_at_epoch = fields.BigIntField(null=True, index=True)
+    updated_at_epoch = fields.BigIntField(null=True, index=True)
+    blueprint: fields.ForeignKeyRelation[Blueprint] = fields.ForeignKeyField("models.Blueprint", related_name="assets", null=True, index=True)
     mint_address = fields.TextField(null=True)
     first_non_mint_address = fields.TextField(null=True)
     checked_first_non_mint_address = fields.BooleanField(null=True)
@@ -52,6 +60,19 @@ class Asset(Model):
 
     async def to_dict(self):
         blueprint = await self.blueprint
+        return self.to_row(blueprint)
+
+    @classmethod
+    async def to_dicts(cls, assets: list["Asset"]) -> list[dict]:
+        # Loads the blueprints of a whole chunk of assets in one query, instead of one query per asset
+        rows = []
+        for start in range(0, len(assets), EXPORT_CHUNK_SIZE):
+            chunk = assets[start:start + EXPORT_CHUNK_SIZE]
+            await cls.fetch_for_list(chunk, "blueprint")
+            rows += [asset.to_row(asset.blueprint) for asset in chunk]
+        return rows
+
+    def to_row(self, blueprint):
         blueprint_data = get_blueprint_data(blueprint)
 
         return {
@@ -77,18 +98,48 @@ class Asset(Model):
         } | self.metadata
 
 
+class Trait(Model):
+    # One row per flattened key/value of an asset's metadata, so assets can be filtered and counted by trait in SQL
+    asset: fields.ForeignKeyRelation[Asset] = fields.ForeignKeyField("models.Asset", related_name="traits", index=True)
+    token_address = fields.TextField()  # Copied from the asset, so a collection's traits are counted without a join
+    key = fields.TextField()
+    value = fields.TextField()
+
+    class Meta:
+        unique_together = (("asset", "key", "value"),)
+        indexes = (("token_address", "key", "value"), ("key", "value"))
+
+
 class Transfer(Model):
     receiver = fields.TextField()
     status = fields.TextField()
     timestamp = fields.TextField()
-    transaction_id = fields.IntField()
+    timestamp_epoch = fields.BigIntField(null=True, index=True)  # timestamp in microseconds since the Unix epoch
+    transaction_id = fields.IntField(unique=True)
     user = fields.TextField()
-    asset: fields.ForeignKeyRelation[Asset] = fields.ForeignKeyField("models.Asset", related_name="transfers")
+    asset: fields.ForeignKeyRelation[Asset] = fields.ForeignKeyField("models.Asset", related_name="transfers", index=True)
+
+    class Meta:
+        # TextFields can't take index=True, so they are indexed here instead. The pairs with timestamp_epoch serve a
+        # user's transfers within a time window
+        indexes = (("user",), ("receiver",), ("user", "timestamp_epoch"), ("receiver", "timestamp_epoch"))
 
     async def to_dict(self):
         asset = await self.asset
         blueprint = await asset.blueprint
+        return self.to_row(asset, blueprint)
+
+    @classmethod
+    async def to_dicts(cls, transfers: list["Transfer"]) -> list[dict]:
+        # Loads assets and their blueprints for a whole chunk of transfers in two queries
+        rows = []
+        for start in range(0, len(transfers), EXPORT_CHUNK_SIZE):
+            chunk = transfers[start:start + EXPORT_CHUNK_SIZE]
+            await cls.fetch_for_list(chunk, "asset__blueprint")
+            rows += [transfer.to_row(transfer.asset, transfer.asset.blueprint) for transfer in chunk]
+        return rows
 
+    def to_row(self, asset, blueprint):
         try:
             blueprint_data = get_blueprint_data(blueprint)
         except Exception:
@@ -110,3 +161,46 @@ class Transfer(Model):
             "asset_blueprint_name": blueprint_data["blueprint_name"],
             "asset_blueprint_edition": blueprint_data["blueprint_edition"],
         }
+
+
+class Mint(Model):
+    transaction_id = fields.IntField(unique=True)
+    status = fields.TextField()
+    timestamp = fields.TextField()
+    timestamp_epoch = fields.BigIntField(null=True, index=True)  # timestamp in microseconds since the Unix epoch
+    user = fields.TextField()
+    asset: fields.ForeignKeyRelation[Asset] = fields.ForeignKeyField("models.Asset", related_name="mints", index=True)
+
+    class Meta:
+        indexes = (("user",), ("user", "timestamp_epoch"))
+
+
+class SyncState(Model):
+    # High-water mark of the newest transfer or mint fetched for an address, so incremental searches only ask for newer ones
+    id = fields.TextField(pk=True)  # f"{address}-{direction}", where direction is "out", "in" or "mints"
+    address = fields.TextField()
+    direction = fields.TextField()
+    last_timestamp = fields.TextField()
+    last_transaction_id = fields.IntField()
+
+
+class Job(Model):
+    # A search or prefetch that can be queued, and resumed from its checkpoint after a crash or quit
+    id = fields.IntField(pk=True)
+    type = fields.TextField()  # One of jobs.JOB_TYPES
+    parameters = fields.JSONField()  # Keyword arguments of the job type's run function
+    status = fields.TextField(default="queued")  # queued, running, complete, failed or interrupted
+    checkpoint = fields.JSONField(default=dict)  # Named resume points, e.g. the last stored page's cursor
+    error = fields.TextField(null=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        indexes = (("status",),)
+
+    def get_checkpoint(self, key: str, default=None):
+        return self.checkpoint.get(key, default)
+
+    async def save_checkpoint(self, key: str, value) -> None:
+        self.checkpoint = self.checkpoint | {key: value}
+        await self.save(update_fields=["checkpoint", "updated_at"])
@@ -0,0 +1,159 @@
+import itertools
+import pytz
+from datetime import datetime
+from rich.text import Text
+
+from textual.app import App
+from textual.timer import Timer
+from textual.widgets import RichLog, Static, ProgressBar, Label, LoadingIndicator
+
+from metrics import Metrics
+
+METRICS_REFRESH_SECONDS = 1
+FRAMES_PER_SECOND = 10  # How often the TUI shows the log lines and progress updates reported since the last frame
+LOG_TIMEZONE = pytz.timezone("America/New_York")
+
+
+class ProgressReporter:
+    # What Searcher reports progress and log messages to. This base class drops everything, for headless use
+    def __init__(self):
+        self.task_ids = itertools.count()
+
+    def log(self, message: str) -> None:
+        pass
+
+    async def start(self, description: str, total: int | None = None) -> int:
+        # total=None is for tasks of unknown length, which get a spinner instead of a progress bar
+        return next(self.task_ids)
+
+    def update(self, task_id: int, description: str) -> None:
+        pass
+
+    def advance(self, task_id: int, amount: int = 1) -> None:
+        pass
+
+    async def finish(self, task_id: int) -> None:
+        pass
+
+    def flush(self) -> None:
+        # Shows anything reported but not yet shown, e.g. before writing straight to the log
+        pass
+
+    def watch_metrics(self, metrics: Metrics) -> None:
+        # Called when a job starts, with the Metrics it records into
+        pass
+
+    def unwatch_metrics(self, metrics: Metrics) -> None:
+        pass
+
+
+class ConsoleProgressReporter(ProgressReporter):
+    # Writes log messages and task start/finish lines to stdout; per-row updates are not printed
+    def __init__(self, prefix: str = ""):
+        super().__init__()
+        self.prefix = prefix
+        self.descriptions: dict[int, str] = {}
+
+    def log(self, message: str) -> None:
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"{timestamp}: {self.prefix}{message}", flush=True)
+
+    async def start(self, description: str, total: int | None = None) -> int:
+        task_id = await super().start(description, total)
+        self.descriptions[task_id] = description
+        self.log(description if total is None else f"{description} ({total} total)")
+        return task_id
+
+    def update(self, task_id: int, description: str) -> None:
+        self.descriptions[task_id] = description
+
+    async def finish(self, task_id: int) -> None:
+        self.log(f"Finished: {self.descriptions.pop(task_id)}")
+
+    def unwatch_metrics(self, metrics: Metrics) -> None:
+        for line in metrics.summary_lines():
+            self.log(line)
+
+
+class TuiProgressReporter(ProgressReporter):
+    # Mounts a label plus a progress bar or loading indicator in the #progress panel for each task. Log lines, label
+    # updates and advances are only recorded when reported, and drawn at most FRAMES_PER_SECOND times a second, so a
+    # search reporting every row doesn't redraw the widgets for every row
+    def __init__(self, app: App):
+        super().__init__()
+        self.app = app
+        self.widgets: dict[int, tuple[Label, ProgressBar | LoadingIndicator]] = {}
+        self.metrics: Metrics | None = None
+        self.metrics_timer: Timer | None = None
+        self.frame_timer: Timer | None = None
+        self.pending_log_lines: list[str] = []
+        self.pending_descriptions: dict[int, str] = {}  # Only the latest description of each task is drawn
+        self.pending_advances: dict[int, int] = {}
+
+    def request_frame(self) -> None:
+        if self.frame_timer is None:
+            self.frame_timer = self.app.set_interval(1 / FRAMES_PER_SECOND, self.flush)
+
+    def flush(self) -> None:
+        if self.pending_log_lines:
+            self.app.query_one("#log", RichLog).write("\n".join(self.pending_log_lines))
+            self.pending_log_lines = []
+
+        for task_id, description in self.pending_descriptions.items():
+            label, _ = self.widgets[task_id]
+            label.update(description)
+        self.pending_descriptions = {}
+
+        for task_id, amount in self.pending_advances.items():
+            _, indicator = self.widgets[task_id]
+            if isinstance(indicator, ProgressBar):  # Tasks of unknown length have nothing to advance
+                indicator.advance(amount)
+        self.pending_advances = {}
+
+    def log(self, message: str) -> None:
+        timestamp = datetime.now(LOG_TIMEZONE).strftime("%Y-%m-%d %H:%M")
+        self.pending_log_lines.append(f"{timestamp}: {message}")
+        self.request_frame()
+
+    async def start(self, description: str, total: int | None = None) -> int:
+        task_id = await super().start(description, total)
+        progress_box = self.app.query_one("#progress", Static)
+        label = Label(description)
+        indicator = LoadingIndicator() if total is None else ProgressBar(total=total)
+        await progress_box.mount(label)
+        await progress_box.mount(indicator)
+        self.widgets[task_id] = (label, indicator)
+        return task_id
+
+    def update(self, task_id: int, description: str) -> None:
+        self.pending_descriptions[task_id] = description
+        self.request_frame()
+
+    def advance(self, task_id: int, amount: int = 1) -> None:
+        self.pending_advances[task_id] = self.pending_advances.get(task_id, 0) + amount
+        self.request_frame()
+
+    async def finish(self, task_id: int) -> None:
+        # The task's widgets are removed, so its undrawn updates are dropped
+        self.pending_descriptions.pop(task_id, None)
+        self.pending_advances.pop(task_id, None)
+        label, indicator = self.widgets.pop(task_id)
+        await label.remove()
+        await indicator.remove()
+
+    def show_metrics(self) -> None:
+        if self.metrics is not None:
+            self.app.query_one("#metrics", Static).update(Text("\n".join(self.metrics.summary_lines())))
+
+    def watch_metrics(self, metrics: Metrics) -> None:
+        self.metrics = metrics
+        if self.metrics_timer is None:
+            self.metrics_timer = self.app.set_interval(METRICS_REFRESH_SECONDS, self.show_metrics)
+        self.show_metrics()
+
+    def unwatch_metrics(self, metrics: Metrics) -> None:
+        # The finished job's numbers stay up until the next job starts
+        self.show_metrics()
+        if self.metrics is metrics and self.metrics_timer is not None:
+            self.metrics_timer.stop()
+            self.metrics_timer = None
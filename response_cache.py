@@ -0,0 +1,136 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+
+from api_models import loads
+
+RESPONSE_CACHE_DIR = "response_cache"
+LISTING_TTL = 10 * 60  # Seconds. Listings and transfer histories gain rows over time, so they are only reused briefly
+NOT_FOUND_TTL = 60 * 60  # Token ids that aren't minted yet can be minted at any time
+CACHEABLE_STATUS_CODES = (200, 404)
+
+# Single asset and mintable token lookups do not change once minted, so they are kept forever (ttl None)
+IMMUTABLE_ENDPOINTS = (
+    re.compile(r"/assets/[^/]+/[^/]+$"),
+    re.compile(r"/mintable-token/[^/]+/[^/]+$"),
+)
+
+# Entries that expire are kept in a directory per TTL, so prune can tell which have expired without opening them
+EXPIRING_DIRECTORIES = {LISTING_TTL: "listings", NOT_FOUND_TTL: "not_found"}
+
+
+class OfflineCacheMiss(Exception):
+    pass
+
+
+def is_immutable(url: str) -> bool:
+    path = httpx.URL(url).path
+    return any(endpoint.search(path) for endpoint in IMMUTABLE_ENDPOINTS)
+
+
+def get_ttl(url: str, status_code: int) -> float | None:
+    if not is_immutable(url):
+        return LISTING_TTL
+    return None if status_code == 200 else NOT_FOUND_TTL
+
+
+def get_possible_ttls(url: str) -> tuple[float | None, ...]:
+    # The TTLs a cached response of the URL could have been stored with, as its status code isn't known before reading
+    return (None, NOT_FOUND_TTL) if is_immutable(url) else (LISTING_TTL,)
+
+
+class ResponseCache:
+    # Gzipped API responses on disk, addressed by a hash of the URL and query parameters
+    def __init__(self, directory: str | Path = RESPONSE_CACHE_DIR, offline: bool = False):
+        self.directory = Path(directory)
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        if not offline:  # Offline replay serves whatever is on disk, so nothing is deleted then
+            self.prune()
+
+    @staticmethod
+    def get_key(url: str, params: dict | None) -> str:
+        request_id = json.dumps([url, sorted((params or {}).items())], default=str)
+        return hashlib.sha256(request_id.encode("utf-8")).hexdigest()
+
+    def get_directory(self, ttl: float | None) -> Path:
+        return self.directory if ttl is None else self.directory / EXPIRING_DIRECTORIES[ttl]
+
+    def get_path(self, key: str, ttl: float | None) -> Path:
+        return self.get_directory(ttl) / key[:2] / f"{key}.json.gz"  # Sharded so no directory gets too large
+
+    def read(self, path: Path, ttl: float | None) -> dict | None:
+        try:
+            # Offline replay serves whatever is on disk, however old
+            if not self.offline and ttl is not None and time.time() - path.stat().st_mtime > ttl:
+                return None
+            with gzip.open(path, "rb") as f:
+                entry = loads(f.read())
+        except FileNotFoundError:
+            return None
+        if ttl is None and entry["status_code"] != 200:
+            return None  # A not found response kept forever by an older version of the cache
+        return entry
+
+    def get(self, url: str, params: dict | None) -> httpx.Response | None:
+        key = self.get_key(url, params)
+        entry = None
+        for ttl in get_possible_ttls(url):
+            entry = self.read(self.get_path(key, ttl), ttl)
+            if entry is not None:
+                break
+        if entry is None:
+            self.misses += 1
+            if self.offline:
+                raise OfflineCacheMiss(f"{url} {params} is not in the response cache")
+            return None
+
+        self.hits += 1
+        return httpx.Response(
+            entry["status_code"],
+            content=entry["content"].encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            request=httpx.Request("GET", url, params=params),
+        )
+
+    def put(self, url: str, params: dict | None, response: httpx.Response) -> None:
+        if response.status_code not in CACHEABLE_STATUS_CODES:
+            return
+
+        path = self.get_path(self.get_key(url, params), get_ttl(url, response.status_code))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written to a temporary file first so a crash never leaves a truncated entry behind
+        temporary_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        with gzip.open(temporary_path, "wt", encoding="utf-8") as f:
+            json.dump({"url": url, "params": params, "status_code": response.status_code, "content": response.text}, f, default=str)
+        os.replace(temporary_path, path)
+
+    def prune(self) -> int:
+        # Deletes the expired entries, returning how many there were. Entries kept forever are never looked at
+        num_deleted = 0
+        now = time.time()
+        for ttl in EXPIRING_DIRECTORIES:
+            for path in self.get_directory(ttl).glob("*/*.json.gz"):
+                try:
+                    if now - path.stat().st_mtime > ttl:
+                        path.unlink()
+                        num_deleted += 1
+                except FileNotFoundError:  # Replaced or deleted by another process
+                    pass
+        return num_deleted
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,105 +1,327 @@
-import pytz
-import httpx
+import asyncio
+import random
 import time
-from datetime import datetime
-from textual.app import App
-from textual.widgets import RichLog, Static, ProgressBar, Label, LoadingIndicator, Pretty
-
-from models import Asset, Blueprint, Transfer
-from deserializers import create_asset
+import httpx
+from contextlib import aclosing
+from pydantic import TypeAdapter
+
+from api_models import Token, TransferResponse, MintResponse, ASSET_PAGE, TRANSFER_PAGE, MINT_PAGE, ASSET, MINTABLE_TOKEN
+from blueprint_search import index_blueprint_name, find_blueprint_names
+from cache import LookupCache
+from metrics import Metrics, get_metrics
+from progress import ProgressReporter
+from response_cache import ResponseCache
+from models import Asset, Blueprint, Transfer, Mint, SyncState, Job, EXPORT_CHUNK_SIZE
+from deserializers import create_asset, create_assets, create_transfers, create_mints
+from lineage import get_local_lineages, save_lineages, LINEAGE_FIELDS
+from traits import parse_trait_query, iterate_assets_by_traits
+from utils import parse_timestamp
 
 BASE_URL = "https://api.x.immutable.com/v1"
 HEADERS = {"Content-Type": "application/json"}
 TEST_LIMIT = 100
+MAX_CONNECTIONS = 10
+KEEPALIVE_EXPIRY = 30
+REQUESTS_PER_SECOND = 5
+DEFAULT_PREFETCH_WORKERS = 8
+DEFAULT_LINEAGE_WORKERS = 8
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 200  # Largest page_size the API accepts
+DEFAULT_LOOK_AHEAD = 2
+PREFETCH_CHECKPOINT_SECONDS = 10
+LOOKUP_CACHE_SIZE = 50_000
+NEGATIVE_CACHE_TTL = 60 * 60
+
+
+class RateLimiter:
+    # Spaces out request start times so that all callers together stay within one budget
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second
+        self.next_request_time = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_request_time - now
+            self.next_request_time = max(now, self.next_request_time) + self.interval
+
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+    async def pause(self, seconds: float):
+        # Pushes back every caller, not just the one that got rate limited
+        async with self.lock:
+            self.next_request_time = max(self.next_request_time, time.monotonic() + seconds)
 
 
 class Searcher:
-    def __init__(self, app: App, test_mode: bool = False):
-        self.app = app
+    def __init__(
+        self,
+        progress: ProgressReporter,
+        test_mode: bool = False,
+        http2: bool = False,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        look_ahead: int = DEFAULT_LOOK_AHEAD,
+        response_cache: ResponseCache | None = None,
+        requests_per_second: float = REQUESTS_PER_SECOND,
+        transport: httpx.AsyncBaseTransport | None = None,  # Lets the API be swapped out, e.g. for fake_api.FakeImxApi
+    ):
+        self.progress = progress
+        self.response_cache = response_cache
         self.test_mode = test_mode
+        self.page_size = page_size
+        self.look_ahead = look_ahead
+        # Both caches are keyed by asset id (token_address-token_id)
+        self.asset_cache = LookupCache(LOOKUP_CACHE_SIZE, NEGATIVE_CACHE_TTL)
+        self.blueprint_cache = LookupCache(LOOKUP_CACHE_SIZE, NEGATIVE_CACHE_TTL)
+        self.rate_limiter = RateLimiter(requests_per_second)
+        # One pooled client for the lifetime of the searcher, so connections are kept alive between requests
+        self.client = httpx.AsyncClient(
+            verify=False,
+            timeout=60,
+            http2=http2,
+            transport=transport,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+        )
+
+    async def close(self):
+        await self.client.aclose()
 
     def send_to_log(self, message):
-        timezone = pytz.timezone("America/New_York")
-        timestamp = datetime.now(timezone).strftime("%Y-%m-%d %H:%M")
-        log = self.app.query_one("#log", RichLog)
-        log.write(f"{timestamp}: {message}")
+        self.progress.log(message)
+
+    @property
+    def metrics(self) -> Metrics:
+        return get_metrics()
+
+    def get_cache_stats(self) -> dict[str, dict]:
+        cache_stats = {"Asset": self.asset_cache.stats(), "Blueprint": self.blueprint_cache.stats()}
+        if self.response_cache is not None:
+            cache_stats["Response"] = self.response_cache.stats()
+        return cache_stats
+
+    def log_cache_stats(self):
+        for name, stats in self.get_cache_stats().items():
+            known_missing = f", {stats['negative_hits']} known missing" if "negative_hits" in stats else ""
+            self.send_to_log(f"{name} cache: {stats['hits']} hits, {stats['misses']} misses{known_missing} ({stats['hit_rate']:.0%} hit rate)")
 
     async def rate_limited_request(self, url, headers, params):
+        if self.response_cache is not None:
+            cached_response = self.response_cache.get(url, params)
+            if cached_response is not None:
+                self.metrics.record_cached_response()
+                return cached_response
+
         backoff_time = .2  # Default rate throttling is 5 requests per second
         status_code = 200
         first_run = True
 
         while first_run or status_code == 429 or (status_code >= 500 and status_code <= 599):
             first_run = False
-            async with httpx.AsyncClient(verify=False, timeout=60) as client:
-                response = await client.get(url, headers=headers, params=params)
+            await self.rate_limiter.wait()
+            start_time = time.perf_counter()
+            response = await self.client.get(url, headers=headers, params=params)
             status_code = response.status_code
-            if status_code == 429:
-                self.send_to_log(f'Detected rate limit. Backing off for {backoff_time} seconds')
-                time.sleep(backoff_time)
-                backoff_time = backoff_time * 2
-            elif 500 <= status_code <= 599:
-                self.send_to_log(f"Got {status_code}; retrying in {backoff_time} seconds")
-                time.sleep(backoff_time)
+            self.metrics.record_request(url, status_code, time.perf_counter() - start_time)
+            if status_code == 429 or 500 <= status_code <= 599:
+                # Jitter keeps concurrent requests from retrying in lockstep
+                sleep_time = backoff_time + random.uniform(0, backoff_time)
+                if status_code == 429:
+                    self.send_to_log(f'Detected rate limit. Backing off for {sleep_time:.2f} seconds')
+                else:
+                    self.send_to_log(f"Got {status_code}; retrying in {sleep_time:.2f} seconds")
+                self.metrics.record_retry(status_code, sleep_time)
+                await self.rate_limiter.pause(sleep_time)
+                await asyncio.sleep(sleep_time)
                 backoff_time = backoff_time * 2
 
+        if self.response_cache is not None:
+            self.response_cache.put(url, params, response)
         return response
 
+    async def paginate(self, url: str, params: dict, page_adapter: TypeAdapter, page_size: int | None = None, look_ahead: int | None = None):
+        async with aclosing(self.paginate_with_cursors(url, params, page_adapter, None, page_size, look_ahead)) as pages:
+            async for page, _ in pages:
+                yield page
+
+    async def paginate_with_cursors(
+        self,
+        url: str,
+        params: dict,
+        page_adapter: TypeAdapter,  # One of the api_models page adapters, which the pages are validated with
+        cursor: str | None = None,
+        page_size: int | None = None,
+        look_ahead: int | None = None,
+    ):
+        # Yields (result list, cursor of the next page) for each page, starting after cursor if given, while up to
+        # look_ahead later pages are fetched in the background. The cursor is what a job checkpoints to resume from
+        page_size = self.page_size if page_size is None else page_size
+        look_ahead = self.look_ahead if look_ahead is None else look_ahead
+        pages: asyncio.Queue = asyncio.Queue(maxsize=max(look_ahead, 1))
+
+        async def fetch_pages():
+            try:
+                remaining = 1
+                next_cursor = cursor
+                while remaining > 0:
+                    page_params = params | {'page_size': page_size}
+                    if next_cursor is not None:
+                        page_params['cursor'] = next_cursor
+                    response = await self.rate_limited_request(url, HEADERS, page_params)
+                    page = page_adapter.validate_json(response.content)
+                    remaining = page['remaining']
+                    next_cursor = page['cursor']
+                    await pages.put((page['result'], next_cursor))
+                await pages.put(None)
+            except Exception as e:
+                await pages.put(e)
+
+        fetcher = asyncio.create_task(fetch_pages())
+        try:
+            while True:
+                page = await pages.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            fetcher.cancel()
+
+    async def run_workers(self, items, handle, num_workers: int):
+        # Calls handle(item) for every item with up to num_workers running at once. All of them share
+        # self.rate_limiter, so adding workers only fills time otherwise spent waiting on latency
+        queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+
+        async def worker():
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await handle(item)
+
+        workers = [asyncio.create_task(worker()) for _ in range(max(num_workers, 1))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def iterate_asset_list_by_metadata(self, asset_name: str):
+        # Yields each page of assets once it is stored
+        num_assets = 0
+        async with aclosing(self.paginate(BASE_URL + '/assets', {'name': asset_name}, ASSET_PAGE)) as pages:
+            async for page in pages:
+                with self.metrics.timed("db", rows=len(page)):
+                    assets = await create_assets(page)
+                yield assets
+                num_assets += len(assets)
+
+                if self.test_mode and num_assets >= TEST_LIMIT:
+                    break
+
     async def get_asset_list_by_metadata(self, asset_name: str) -> list[Asset]:
-        remaining = 1
-        cursor = None
         all_assets: list[Asset] = []
-        while remaining > 0:
-            params = {'name': asset_name }
-            if cursor is not None:
-                params['cursor'] = cursor
-
-            asset_list_response = await self.rate_limited_request(BASE_URL + '/assets', HEADERS, params)
-
-            asset_list_response = asset_list_response.json()
-            remaining = asset_list_response['remaining']
-            cursor = asset_list_response['cursor']
-            assets = [await create_asset(asset_dict) for asset_dict in asset_list_response['result']]
-            all_assets.extend(assets)
-
-            if self.test_mode and len(all_assets) >= TEST_LIMIT:
-                break
-
+        async with aclosing(self.iterate_asset_list_by_metadata(asset_name)) as pages:
+            async for assets in pages:
+                all_assets.extend(assets)
         return all_assets
 
-    async def get_asset_list_by_blueprint(self, blueprint: str) -> list[Asset]:
-        all_assets: list[Asset] = []
-
+    async def iterate_asset_list_by_blueprint(self, blueprint: str):
+        # Yields the assets a page_size page at a time, as their blueprints are looked up
         matching_blueprints = await Blueprint.filter(name=blueprint)
-        progress_box = self.app.query_one("#progress", Static)
-
-        progress_bar_label = Label("Getting asset details")
-        await progress_box.mount(progress_bar_label)
-        progress_bar = ProgressBar(total=len(matching_blueprints))
-        await progress_box.mount(progress_bar)
-
+        if not matching_blueprints:
+            # Falls back to the closest names, best first, rather than finding nothing for a typo or partial name
+            names = await find_blueprint_names(blueprint)
+            if names:
+                self.send_to_log(f"No blueprint is named exactly {blueprint}; using the closest matches: {', '.join(names)}")
+            rank = {name: i for i, name in enumerate(names)}
+            matching_blueprints = sorted(await Blueprint.filter(name__in=list(rank)), key=lambda matching_blueprint: rank[matching_blueprint.name])
+        progress_task = await self.progress.start("Getting assets by blueprint", total=len(matching_blueprints))
+
+        assets: list[Asset] = []
         for matching_blueprint in matching_blueprints:
-            asset = await Asset.get_or_none(
-                blueprint=matching_blueprint
-            )
+            with self.metrics.timed("db"):
+                asset = await Asset.get_or_none(
+                    blueprint=matching_blueprint
+                )
             if asset is None:
                 asset_detail_response = await self.rate_limited_request(BASE_URL + f'/assets/{matching_blueprint.token_address}/{matching_blueprint.token_id}', HEADERS, None)
-                asset = await create_asset(asset_detail_response.json())
-                asset.blueprint = matching_blueprint
-                await asset.save()
+                with self.metrics.timed("db", rows=1):
+                    asset = await create_asset(ASSET.validate_json(asset_detail_response.content))
+                    asset.blueprint = matching_blueprint
+                    await asset.save()
 
-            all_assets.append(asset)
-            progress_bar.advance(1)
+            assets.append(asset)
+            self.progress.advance(progress_task)
+            if len(assets) >= self.page_size:
+                yield assets
+                assets = []
 
-        await progress_bar_label.remove()
-        await progress_bar.remove()
+        if assets:
+            yield assets
+        await self.progress.finish(progress_task)
 
+    async def get_asset_list_by_blueprint(self, blueprint: str) -> list[Asset]:
+        all_assets: list[Asset] = []
+        async with aclosing(self.iterate_asset_list_by_blueprint(blueprint)) as pages:
+            async for assets in pages:
+                all_assets.extend(assets)
+        return all_assets
+
+    async def iterate_asset_list_by_traits(self, trait_query: str):
+        # Only searches assets already in the database, e.g. from a metadata search or blueprint prefetch
+        traits, token_address = parse_trait_query(trait_query)
+        num_assets = 0
+        async with aclosing(iterate_assets_by_traits(traits, token_address, self.page_size)) as pages:
+            while True:
+                with self.metrics.timed("db"):
+                    assets = await anext(pages, None)
+                if assets is None:
+                    return
+                if self.test_mode:
+                    assets = assets[:TEST_LIMIT - num_assets]
+                yield assets
+                num_assets += len(assets)
+                if self.test_mode and num_assets >= TEST_LIMIT:
+                    return
+
+    async def get_asset_list_by_traits(self, trait_query: str) -> list[Asset]:
+        all_assets: list[Asset] = []
+        async with aclosing(self.iterate_asset_list_by_traits(trait_query)) as pages:
+            async for assets in pages:
+                all_assets.extend(assets)
         return all_assets
 
-    async def get_blueprint_of_asset(self, asset) -> Blueprint:
+    async def get_blueprint_of_asset(self, asset) -> Blueprint | None:
+        if self.blueprint_cache.is_missing(asset.id):
+            return None
+        blueprint = self.blueprint_cache.get(asset.id)
+        if blueprint is not None:
+            return blueprint
+
+        if asset.blueprint_id is not None:
+            with self.metrics.timed("db"):
+                blueprint = await Blueprint.get_or_none(blueprint=asset.blueprint_id)
+            if blueprint is not None:
+                self.blueprint_cache.put(asset.id, blueprint)
+                return blueprint
+
         full_mintable_token_url = f"{BASE_URL}/mintable-token/{asset.token_address}/{asset.token_id}"
         mintable_token = await self.rate_limited_request(full_mintable_token_url, HEADERS, None)
-        blueprint = mintable_token.json()['blueprint']
+        if mintable_token.status_code == 404:
+            self.send_to_log(f"Mintable token {asset.id} not found")
+            self.blueprint_cache.put_missing(asset.id)
+            return None
+        blueprint = MINTABLE_TOKEN.validate_json(mintable_token.content)['blueprint']
         try:
             split_blueprint = blueprint.split(',')
             blueprint_name = split_blueprint[0]
@@ -108,124 +330,249 @@ class Searcher:
             blueprint_name = None
             blueprint_edition = None
 
-        blueprint, created = await Blueprint.get_or_create(
-            blueprint=blueprint,
-            defaults=dict(
-                name=blueprint_name,
-                edition=blueprint_edition,
-                token_address=asset.token_address,
-                token_id=asset.token_id
+        with self.metrics.timed("db", rows=1):
+            blueprint, created = await Blueprint.get_or_create(
+                blueprint=blueprint,
+                defaults=dict(
+                    name=blueprint_name,
+                    edition=blueprint_edition,
+                    token_address=asset.token_address,
+                    token_id=asset.token_id
+                )
             )
-        )
+            if created:
+                await index_blueprint_name(blueprint.name)
 
+        self.blueprint_cache.put(asset.id, blueprint)
         return blueprint
 
     async def get_asset_details(self, token_address: str, token_id:str, get_first_non_mint_user: bool) -> Asset | None:
-        print(token_id)
         asset_id = f"{token_address}-{token_id}"
-        asset = await Asset.get_or_none(id=asset_id)
+        if self.asset_cache.is_missing(asset_id):
+            return None
+        asset = self.asset_cache.get(asset_id)
+        if asset is None:
+            with self.metrics.timed("db"):
+                asset = await Asset.get_or_none(id=asset_id)
         if asset is None:
             asset_detail_response = await self.rate_limited_request(
                 BASE_URL + f'/assets/{token_address}/{token_id}', HEADERS, None)
             if asset_detail_response.status_code == 404:
                 self.send_to_log(f"Asset {token_address}-{token_id} not found")
+                self.asset_cache.put_missing(asset_id)
                 return None
-            asset = await create_asset(asset_detail_response.json())
+            with self.metrics.timed("db", rows=1):
+                asset = await create_asset(ASSET.validate_json(asset_detail_response.content))
             blueprint = await self.get_blueprint_of_asset(asset)
             asset.blueprint = blueprint
-            await asset.save()
+            with self.metrics.timed("db"):
+                await asset.save()
+        self.asset_cache.put(asset_id, asset)
 
         # This updates the asset with the first non-mint user
         if (not asset.checked_first_non_mint_address) and get_first_non_mint_user:
             asset, _ = await self.get_transfer_history_of_asset(asset)
-            await asset.save()
+            with self.metrics.timed("db"):
+                await asset.save(update_fields=["user", *LINEAGE_FIELDS])
 
         return asset
 
-    async def get_transfer_history_of_user(self, user_address: str, direction: str, get_first_non_mint_user: bool) -> tuple[list[Transfer], list[Asset]]:
-        progress_box = self.app.query_one("#progress", Static)
-        loading_indicator_label = Pretty(f"Getting transfer history {direction} (0 transfers so far)")
-        await progress_box.mount(loading_indicator_label)
-        loading_indicator = LoadingIndicator()
-        await progress_box.mount(loading_indicator)
+    async def get_asset_of_token(self, token: Token) -> Asset | None:
+        # ETH and ERC20 tokens have no token_id and aren't assets, so they are skipped without a request
+        token_address = token['data'].get('token_address')
+        token_id = token['data'].get('token_id')
+        if not token_address or not token_id:
+            return None
+        return await self.get_asset_details(token_address, token_id, False)
+
+    async def get_high_water_mark_params(self, user_address: str, direction: str) -> dict:
+        sync_state = await SyncState.get_or_none(id=f"{user_address}-{direction}")
+        if sync_state is None:
+            return {}
+
+        self.send_to_log(f"Only getting {direction} records since {sync_state.last_timestamp}")
+        # min_timestamp is inclusive, so the newest record is fetched again and skipped as already stored
+        return {'min_timestamp': sync_state.last_timestamp}
+
+    async def update_high_water_mark(self, user_address: str, direction: str, newest_dict: dict | None) -> None:
+        if newest_dict is None:
+            return
+
+        sync_state = await SyncState.get_or_none(id=f"{user_address}-{direction}")
+        if sync_state is None:
+            sync_state = SyncState(id=f"{user_address}-{direction}", address=user_address, direction=direction)
+        elif parse_timestamp(sync_state.last_timestamp) >= parse_timestamp(newest_dict['timestamp']):
+            return
+
+        sync_state.last_timestamp = newest_dict['timestamp']
+        sync_state.last_transaction_id = newest_dict['transaction_id']
+        await sync_state.save()
+
+    @staticmethod
+    def get_newest_dict(record_dicts: list[TransferResponse] | list[MintResponse], newest_dict: dict | None) -> dict | None:
+        if newest_dict is not None:
+            record_dicts = record_dicts + [newest_dict]
+        if not record_dicts:
+            return None
+        return max(record_dicts, key=lambda record_dict: parse_timestamp(record_dict['timestamp']))
+
+    @staticmethod
+    def get_resume_point(job: Job | None, key: str, params: dict) -> dict | None:
+        # A checkpoint only applies to the same query, e.g. not once an incremental search asks from a newer timestamp
+        if job is None:
+            return None
+        resume_point = job.get_checkpoint(key)
+        if resume_point is None or resume_point['params'] != params:
+            return None
+        return resume_point
+
+    @staticmethod
+    async def save_resume_point(job: Job | None, key: str, params: dict, cursor: str | None, newest_dict: dict | None, done: bool = False) -> None:
+        if job is not None:
+            await job.save_checkpoint(key, {'params': params, 'cursor': cursor, 'newest': newest_dict, 'done': done})
+
+    async def iterate_stored_records(self, queryset, seen_ids: set[int]):
+        # Pages of the query's records with their assets loaded, in id order, skipping those in seen_ids
+        last_id = 0
+        while True:
+            with self.metrics.timed("db"):
+                records = await queryset.filter(id__gt=last_id).order_by("id").limit(EXPORT_CHUNK_SIZE)
+            if not records:
+                return
+            last_id = records[-1].id
+            records = [record for record in records if record.id not in seen_ids]
+            if records:
+                with self.metrics.timed("db", rows=len(records)):
+                    await type(records[0]).fetch_for_list(records, "asset")
+                yield records
+
+    async def iterate_transfer_history_of_user(self, user_address: str, direction: str, get_first_non_mint_user: bool, incremental: bool = False, job: Job | None = None):
+        # Yields (transfers, their assets) for each page once it is stored and, with get_first_non_mint_user, once the
+        # page's assets have their lineages. Incremental and resumed searches then yield the older stored transfers
+        progress_task = await self.progress.start(f"Getting transfer history {direction} (0 transfers so far)")
 
         self.send_to_log(f"Getting transfer {direction} history")
 
-        transfer_history: list[Transfer] = []
-        all_assets: list[Asset] = []
-        remaining = 1
-        cursor = None
+        seen_ids: set[int] = set()
         total_transfers = 0
-        while remaining > 0:
-            if direction == 'out':
-                params = {'user': user_address}
-            else:
-                params = {'receiver': user_address}
-            if cursor is not None:
-                params['cursor'] = cursor
-            transfers_response = await self.rate_limited_request(BASE_URL + '/transfers', HEADERS, params)
-            transfers_response = transfers_response.json()
-            remaining = transfers_response['remaining']
-
-            cursor = transfers_response['cursor']
-            for transfer_dict in transfers_response['result']:
-                asset_token_address = transfer_dict['token']['data']['token_address']
-                asset_token_id = transfer_dict['token']['data']['token_id']
-                asset = await self.get_asset_details(asset_token_address, asset_token_id, get_first_non_mint_user)
-
-                transfer, _ = await Transfer.get_or_create(
-                    transaction_id=transfer_dict['transaction_id'],
-                    defaults=dict(
-                        receiver=transfer_dict['receiver'],
-                        status=transfer_dict['status'],
-                        timestamp=transfer_dict['timestamp'],
-                        user=transfer_dict['user'],
-                        asset=asset
-                    )
-                )
-                transfer_history.append(transfer)
-                if asset is not None:
-                    all_assets.append(asset)
-
-                total_transfers += 1
-                loading_indicator_label.update(f"Getting transfer history {direction} ({total_transfers} transfers so far)")
-
-            if self.test_mode and len(transfer_history) >= TEST_LIMIT:
-                break
-
-        await loading_indicator_label.remove()
-        await loading_indicator.remove()
+        if direction == 'out':
+            address_filter = {'user': user_address}
+        else:
+            address_filter = {'receiver': user_address}
+        params = dict(address_filter)
+        if incremental:
+            params |= await self.get_high_water_mark_params(user_address, direction)
+
+        checkpoint_key = f'transfers_{direction}'
+        resume_point = self.get_resume_point(job, checkpoint_key, params)
+        if resume_point is not None:
+            self.send_to_log(f"Resuming transfer {direction} history from the job's checkpoint")
+
+        newest_dict = None if resume_point is None else resume_point['newest']
+        complete = True
+        if resume_point is None or not resume_point['done']:
+            cursor = None if resume_point is None else resume_point['cursor']
+            async with aclosing(self.paginate_with_cursors(BASE_URL + '/transfers', params, TRANSFER_PAGE, cursor)) as pages:
+                async for page, next_cursor in pages:
+                    newest_dict = self.get_newest_dict(page, newest_dict)
+                    page_assets: list[Asset | None] = []
+                    for transfer_dict in page:
+                        asset = await self.get_asset_of_token(transfer_dict['token'])
+
+                        page_assets.append(asset)
+
+                        total_transfers += 1
+                        self.progress.update(progress_task, f"Getting transfer history {direction} ({total_transfers} transfers so far)")
+
+                    with self.metrics.timed("db", rows=len(page)):
+                        transfers = await create_transfers(page, page_assets)
+                    assets = [asset for asset in page_assets if asset is not None]
+                    # This updates the assets with the first non-mint user
+                    if get_first_non_mint_user:
+                        await self.resolve_lineages([asset for asset in assets if not asset.checked_first_non_mint_address])
+                    await self.save_resume_point(job, checkpoint_key, params, next_cursor, newest_dict)
+
+                    seen_ids.update(transfer.id for transfer in transfers)
+                    yield transfers, assets
+
+                    if self.test_mode and len(seen_ids) >= TEST_LIMIT:
+                        complete = False
+                        break
+
+        if incremental or resume_point is not None:
+            # Older transfers were stored by earlier runs, or before the job was interrupted, so the rest of the history
+            # comes from the local database
+            async with aclosing(self.iterate_stored_records(Transfer.filter(**address_filter), seen_ids)) as stored_pages:
+                async for transfers in stored_pages:
+                    assets = [transfer.asset for transfer in transfers]
+                    if get_first_non_mint_user:
+                        await self.resolve_lineages([asset for asset in assets if not asset.checked_first_non_mint_address])
+                    yield transfers, assets
+
+        # Only a full pass can move the high-water mark, otherwise the skipped records would never be fetched
+        if complete:
+            await self.update_high_water_mark(user_address, direction, newest_dict)
+            await self.save_resume_point(job, checkpoint_key, params, None, newest_dict, done=True)
+
+        await self.progress.finish(progress_task)
         self.send_to_log(f"Successfully got transfer {direction} history")
 
+    async def get_transfer_history_of_user(self, user_address: str, direction: str, get_first_non_mint_user: bool, incremental: bool = False, job: Job | None = None) -> tuple[list[Transfer], list[Asset]]:
+        transfer_history: list[Transfer] = []
+        all_assets: list[Asset] = []
+        async with aclosing(self.iterate_transfer_history_of_user(user_address, direction, get_first_non_mint_user, incremental, job)) as pages:
+            async for transfers, assets in pages:
+                transfer_history += transfers
+                all_assets += assets
         return transfer_history, all_assets
 
-    async def get_transfer_history_of_asset(self, asset: Asset) -> tuple[Asset, list[Transfer]]:
-        current_holder = asset.user
-        prior_holder = None
-        num_transfers = 0
-        transfers_querystring = {
+    @staticmethod
+    def get_transfers_querystring(asset: Asset) -> dict:
+        return {
              'token_address': asset.token_address,
              'token_id': asset.token_id,
              'direction': 'desc'
         }
-        transfers_response = await self.rate_limited_request(BASE_URL + '/transfers', HEADERS, transfers_querystring)
-        response_json = transfers_response.json()['result']
+
+    async def is_newest_transfer_stored(self, asset: Asset) -> bool:
+        # A single-row probe of the API for the asset's newest transfer
+        newest_response = await self.rate_limited_request(BASE_URL + '/transfers', HEADERS, self.get_transfers_querystring(asset) | {'page_size': 1})
+        newest = TRANSFER_PAGE.validate_json(newest_response.content)['result']
+        with self.metrics.timed("db"):
+            if not newest:
+                return not await Transfer.exists(asset_id=asset.id)
+            return await Transfer.exists(transaction_id=newest[0]['transaction_id'], asset_id=asset.id)
+
+    async def is_transfer_history_unchanged(self, asset: Asset) -> bool:
+        # If the newest transfer is already stored and we stored as many transfers as we counted last time, there is
+        # nothing new to page through
+        if not asset.checked_first_non_mint_address or asset.num_transfers is None:
+            return False
+        if not await self.is_newest_transfer_stored(asset):
+            return False
+        return await Transfer.filter(asset_id=asset.id).count() == asset.num_transfers
+
+    async def get_transfer_history_of_asset(self, asset: Asset, known_changed: bool = False) -> tuple[Asset, list[Transfer]]:
+        # known_changed skips the check for an unchanged history, for callers whose own probe already found the API's
+        # newest transfer missing from the database
+        prior_holder = None
+        num_transfers = 0
+        transfers_querystring = self.get_transfers_querystring(asset)
+        if not known_changed and await self.is_transfer_history_unchanged(asset):
+            return asset, await Transfer.filter(asset_id=asset.id)
 
         transfer_history: list[Transfer] = []
-        for transfer_dict in response_json:
+        async with aclosing(self.paginate(BASE_URL + '/transfers', transfers_querystring, TRANSFER_PAGE)) as pages:
+            async for page in pages:
+                with self.metrics.timed("db", rows=len(page)):
+                    transfer_history += await create_transfers(page, [asset] * len(page))
+
+        # The newest transfer's receiver is the owner, even if the stored owner is from before it
+        if transfer_history:
+            asset.user = transfer_history[0].receiver
+        current_holder = asset.user
+        for transfer in transfer_history:
             num_transfers += 1
-            transfer, _ = await Transfer.get_or_create(
-                transaction_id=transfer_dict['transaction_id'],
-                defaults=dict(
-                    receiver=transfer_dict['receiver'],
-                    status=transfer_dict['status'],
-                    timestamp=transfer_dict['timestamp'],
-                    user=transfer_dict['user'],
-                    asset=asset
-                )
-            )
-
-            transfer_history.append(transfer)
             if current_holder == transfer.receiver:
                 prior_holder = current_holder
                 current_holder = transfer.user
@@ -239,106 +586,249 @@ class Searcher:
 
         return asset, transfer_history
 
-    async def get_minted_assets(self, user_address: str, get_first_non_mint_user: bool) -> list[Asset]:
-        progress_box = self.app.query_one("#progress", Static)
-        loading_indicator_label = Pretty("Getting mints (0 so far)")
-        await progress_box.mount(loading_indicator_label)
-        loading_indicator = LoadingIndicator()
-        await progress_box.mount(loading_indicator)
+    async def resolve_lineages(self, assets: list[Asset], num_workers: int = DEFAULT_LINEAGE_WORKERS, owners_are_fresh: bool = False) -> list[Transfer]:
+        # Works out lineages from the Transfer table where the stored history is complete and up to date, and runs
+        # get_transfer_history_of_asset for the rest, many at once, saving each asset as it finishes. A stored history
+        # that ends with the asset's owner is up to date if the owners were just listed by the API (owners_are_fresh);
+        # otherwise a one-row probe has to find the API's newest transfer already stored
+        full_transfer_history: list[Transfer] = []
+        unique_assets = list({asset.id: asset for asset in assets}.values())
 
-        self.send_to_log("Getting mints")
+        with self.metrics.timed("db"):
+            local_lineages = await get_local_lineages(unique_assets)
 
-        minted_assets: list[Asset] = []
-        total_mints = 0
-        remaining = 1
-        cursor = None
+        unconfirmed_ids: set[str] = set()  # Probed, and the API has a newer transfer than the stored ones
+        if not owners_are_fresh:
+            unconfirmed_ids = set(local_lineages)
+
+            async def confirm(asset: Asset):
+                if await self.is_newest_transfer_stored(asset):
+                    unconfirmed_ids.discard(asset.id)
 
-        while remaining > 0:
-            params = {'user': user_address}
-            if cursor is not None:
-                params['cursor'] = cursor
-            mints_response = await self.rate_limited_request(BASE_URL + '/mints', HEADERS, params)
+            await self.run_workers([asset for asset in unique_assets if asset.id in local_lineages], confirm, num_workers)
+            local_lineages = {asset_id: lineage for asset_id, lineage in local_lineages.items() if asset_id not in unconfirmed_ids}
 
-            mints_response = mints_response.json()
-            remaining = mints_response['remaining']
+        with self.metrics.timed("db"):
+            await save_lineages(unique_assets, local_lineages)
+            local_ids = list(local_lineages)
+            for start in range(0, len(local_ids), EXPORT_CHUNK_SIZE):
+                full_transfer_history += await Transfer.filter(asset_id__in=local_ids[start:start + EXPORT_CHUNK_SIZE])
+        incomplete_assets = [asset for asset in unique_assets if asset.id not in local_lineages]
+        if local_ids:
+            self.send_to_log(f"Worked out {len(local_ids)} lineages from stored transfers; getting {len(incomplete_assets)} from the API")
 
-            cursor = mints_response['cursor']
-            for mint in mints_response['result']:
-                asset_token_address = mint['token']['data']['token_address']
-                asset_token_id = mint['token']['data']['token_id']
-                asset = await self.get_asset_details(asset_token_address, asset_token_id, get_first_non_mint_user)
+        async def resolve(asset: Asset):
+            _, transfer_history = await self.get_transfer_history_of_asset(asset, known_changed=asset.id in unconfirmed_ids)
+            # Only the fields the walk set, so an older copy of the asset can't overwrite newer stored fields
+            with self.metrics.timed("db"):
+                await asset.save(update_fields=["user", *LINEAGE_FIELDS])
+            full_transfer_history.extend(transfer_history)
 
-                if asset is not None:
-                    minted_assets.append(asset)
+        await self.run_workers(incomplete_assets, resolve, num_workers)
+        return full_transfer_history
 
-                total_mints += 1
-                loading_indicator_label.update(f"Getting mints ({total_mints} so far)")
+    async def iterate_minted_assets(self, user_address: str, get_first_non_mint_user: bool, incremental: bool = False, job: Job | None = None):
+        # Yields each page of minted assets, like iterate_transfer_history_of_user
+        progress_task = await self.progress.start("Getting mints (0 so far)")
 
-            if self.test_mode and len(minted_assets) >= TEST_LIMIT:
-                break
+        self.send_to_log("Getting mints")
 
-        await loading_indicator_label.remove()
-        await loading_indicator.remove()
+        seen_ids: set[int] = set()
+        total_mints = 0
+        params = {'user': user_address}
+        if incremental:
+            params |= await self.get_high_water_mark_params(user_address, 'mints')
+
+        resume_point = self.get_resume_point(job, 'mints', params)
+        if resume_point is not None:
+            self.send_to_log("Resuming mints from the job's checkpoint")
+
+        newest_dict = None if resume_point is None else resume_point['newest']
+        complete = True
+        if resume_point is None or not resume_point['done']:
+            cursor = None if resume_point is None else resume_point['cursor']
+            async with aclosing(self.paginate_with_cursors(BASE_URL + '/mints', params, MINT_PAGE, cursor)) as pages:
+                async for page, next_cursor in pages:
+                    newest_dict = self.get_newest_dict(page, newest_dict)
+                    page_assets: list[Asset | None] = []
+                    for mint in page:
+                        asset = await self.get_asset_of_token(mint['token'])
+
+                        page_assets.append(asset)
+
+                        total_mints += 1
+                        self.progress.update(progress_task, f"Getting mints ({total_mints} so far)")
+
+                    with self.metrics.timed("db", rows=len(page)):
+                        mints = await create_mints(page, page_assets)
+                    minted_assets = [asset for asset in page_assets if asset is not None]
+                    if get_first_non_mint_user:
+                        await self.resolve_lineages([asset for asset in minted_assets if not asset.checked_first_non_mint_address])
+                    await self.save_resume_point(job, 'mints', params, next_cursor, newest_dict)
+
+                    seen_ids.update(mint.id for mint in mints)
+                    yield minted_assets
+
+                    if self.test_mode and len(seen_ids) >= TEST_LIMIT:
+                        complete = False
+                        break
+
+        if incremental or resume_point is not None:
+            async with aclosing(self.iterate_stored_records(Mint.filter(user=user_address), seen_ids)) as stored_pages:
+                async for mints in stored_pages:
+                    minted_assets = [mint.asset for mint in mints]
+                    if get_first_non_mint_user:
+                        await self.resolve_lineages([asset for asset in minted_assets if not asset.checked_first_non_mint_address])
+                    yield minted_assets
+
+        if complete:
+            await self.update_high_water_mark(user_address, 'mints', newest_dict)
+            await self.save_resume_point(job, 'mints', params, None, newest_dict, done=True)
+
+        await self.progress.finish(progress_task)
         self.send_to_log(f"Successfully got mints")
 
+    async def get_minted_assets(self, user_address: str, get_first_non_mint_user: bool, incremental: bool = False, job: Job | None = None) -> list[Asset]:
+        minted_assets: list[Asset] = []
+        async with aclosing(self.iterate_minted_assets(user_address, get_first_non_mint_user, incremental, job)) as pages:
+            async for assets in pages:
+                minted_assets += assets
         return minted_assets
 
-    async def asset_search(self, asset_name: str, search_type: str, get_transfer_history: bool = True) -> tuple[list[Asset], list[Transfer]]:
-        full_transfer_history: list[Transfer] = []
-
-        progress_box = self.app.query_one("#progress", Static)
+    async def iterate_asset_search(self, asset_name: str, search_type: str | None, get_transfer_history: bool = True):
+        # Yields (assets, their transfers) a page at a time, once the page's assets have blueprints and lineages.
+        # Metadata searches page through the API; the other searches page through the local database
         if search_type is None:
             search_type = "blueprint"
 
-        loading_indicator_label = Label(f"Getting assets by {search_type}")
-        await progress_box.mount(loading_indicator_label)
-        loading_indicator = LoadingIndicator()
-        await progress_box.mount(loading_indicator)
-
         if search_type == "metadata":
-            all_assets = await self.get_asset_list_by_metadata(asset_name)
+            asset_pages = self.iterate_asset_list_by_metadata(asset_name)
+        elif search_type == "trait":
+            self.send_to_log("WARNING: This only searches assets already in the database! Run a metadata search or blueprint prefetch to populate it")
+            asset_pages = self.iterate_asset_list_by_traits(asset_name)
         else:
             self.send_to_log("WARNING: This only searches assets in the pre-populated blueprints database! Use the blueprint prefetch option to populate it")
-            all_assets = await self.get_asset_list_by_blueprint(asset_name)
+            asset_pages = self.iterate_asset_list_by_blueprint(asset_name)
 
-        await loading_indicator_label.remove()
-        await loading_indicator.remove()
+        progress_task = await self.progress.start("Getting asset details")
+        num_assets = 0
 
-        progress_bar_label = Label("Getting asset details")
-        progress_bar = ProgressBar(
-            total=len(all_assets),
-        )
-        await progress_box.mount(progress_bar_label)
-        await progress_box.mount(progress_bar)
-        for asset in all_assets:
+        async def get_details(asset: Asset):
             blueprint = await self.get_blueprint_of_asset(asset)
             asset.blueprint = blueprint
-            if get_transfer_history:
-                asset, transfer_history = await self.get_transfer_history_of_asset(asset)
-            else:
-                transfer_history = []
-            await asset.save()
-            full_transfer_history += transfer_history
-            progress_bar.advance(1)
+            with self.metrics.timed("db"):
+                await asset.save()
 
-            if self.test_mode:
-                break
+        async with aclosing(asset_pages) as pages:
+            async for assets in pages:
+                if self.test_mode:
+                    detail_assets = assets[:1] if num_assets == 0 else []
+                else:
+                    detail_assets = assets
+                await self.run_workers(detail_assets, get_details, DEFAULT_LINEAGE_WORKERS)
+                if get_transfer_history:
+                    transfers = await self.resolve_lineages(detail_assets, owners_are_fresh=search_type == "metadata")
+                else:
+                    transfers = []
+
+                num_assets += len(assets)
+                self.progress.update(progress_task, f"Getting asset details ({num_assets} so far)")
+                yield assets, transfers
+
+        await self.progress.finish(progress_task)
+
+    async def asset_search(self, asset_name: str, search_type: str | None, get_transfer_history: bool = True) -> tuple[list[Asset], list[Transfer]]:
+        all_assets: list[Asset] = []
+        full_transfer_history: list[Transfer] = []
+        async with aclosing(self.iterate_asset_search(asset_name, search_type, get_transfer_history)) as pages:
+            async for assets, transfers in pages:
+                all_assets += assets
+                full_transfer_history += transfers
+        return all_assets, full_transfer_history
 
-        await progress_bar_label.remove()
-        await progress_bar.remove()
+    async def blueprint_prefetch(self, token_address: str, starting_token_id: int, ending_token_id: int, num_workers: int = DEFAULT_PREFETCH_WORKERS, job: Job | None = None):
+        # The job's checkpoint is the first token id not yet done. Workers finish out of order, so ids done past it
+        # are held in finished_ids until the gap before them closes
+        next_token_id = starting_token_id
+        if job is not None:
+            next_token_id = max(starting_token_id, job.get_checkpoint('next_token_id', starting_token_id))
+            if next_token_id > starting_token_id:
+                self.send_to_log(f"Resuming prefetch from token id {next_token_id}")
+        finished_ids: set[int] = set()
+        last_checkpoint_time = time.monotonic()
 
-        return all_assets, full_transfer_history
+        progress_task = await self.progress.start("Getting asset details", total=ending_token_id - next_token_id)
 
-    async def blueprint_prefetch(self, token_address: str, starting_token_id: int, ending_token_id: int):
-        progress_box = self.app.query_one("#progress", Static)
-        progress_bar_label = Label("Getting asset details")
-        await progress_box.mount(progress_bar_label)
-        progress_bar = ProgressBar(total=ending_token_id - starting_token_id)
-        await progress_box.mount(progress_bar)
+        start_time = time.monotonic()
+        completed = 0
 
-        for token_id in range(starting_token_id, ending_token_id):
+        async def prefetch(token_id: int):
+            nonlocal completed, next_token_id, last_checkpoint_time
             await self.get_asset_details(token_address, str(token_id), False)
-            progress_bar.advance(1)
-
-        await progress_bar_label.remove()
-        await progress_bar.remove()
+            completed += 1
+            self.progress.advance(progress_task)
+            assets_per_second = completed / max(time.monotonic() - start_time, 1e-6)
+            self.progress.update(progress_task, f"Getting asset details ({assets_per_second:.1f} assets/s)")
+
+            finished_ids.add(token_id)
+            while next_token_id in finished_ids:
+                finished_ids.remove(next_token_id)
+                next_token_id += 1
+            if job is not None and time.monotonic() - last_checkpoint_time > PREFETCH_CHECKPOINT_SECONDS:
+                last_checkpoint_time = time.monotonic()
+                await job.save_checkpoint('next_token_id', next_token_id)
+
+        await self.run_workers(range(next_token_id, ending_token_id), prefetch, num_workers)
+        if job is not None:
+            await job.save_checkpoint('next_token_id', next_token_id)
+
+        self.send_to_log(f"Prefetched {completed} assets in {time.monotonic() - start_time:.0f} seconds")
+
+        await self.progress.finish(progress_task)
+
+    async def collection_prefetch(self, token_address: str, num_workers: int = DEFAULT_PREFETCH_WORKERS, job: Job | None = None):
+        # Bulk version of blueprint_prefetch for a whole collection: the assets are listed a full page at a time rather
+        # than looked up one token id per request (missing ids included), and only the assets whose blueprint isn't
+        # stored yet need a /mintable-token request each. The job's checkpoint is the cursor of the next page
+        cursor = None if job is None else job.get_checkpoint('collection_cursor')
+        if cursor is not None:
+            self.send_to_log(f"Resuming prefetch of {token_address} from its last stored page")
+
+        progress_task = await self.progress.start("Listing collection assets", total=None)
+        start_time = time.monotonic()
+        num_assets = 0
+        num_blueprints_fetched = 0
+
+        async def fetch_blueprint(asset: Asset):
+            nonlocal num_blueprints_fetched
+            asset.blueprint = await self.get_blueprint_of_asset(asset)
+            num_blueprints_fetched += 1
+
+        pages = self.paginate_with_cursors(BASE_URL + '/assets', {'collection': token_address}, ASSET_PAGE, cursor, page_size=MAX_PAGE_SIZE)
+        async with aclosing(pages) as pages:
+            async for page, next_cursor in pages:
+                with self.metrics.timed("db", rows=len(page)):
+                    assets = await create_assets(page)
+
+                missing_blueprints = [asset for asset in assets if asset.blueprint_id is None]
+                await self.run_workers(missing_blueprints, fetch_blueprint, num_workers)
+                found_blueprints = [asset for asset in missing_blueprints if asset.blueprint_id is not None]
+                if found_blueprints:
+                    with self.metrics.timed("db", rows=len(found_blueprints)):
+                        await Asset.bulk_update(found_blueprints, fields=["blueprint_id"])
+
+                for asset in assets:
+                    self.asset_cache.put(asset.id, asset)
+                if job is not None:
+                    await job.save_checkpoint('collection_cursor', next_cursor)
+
+                num_assets += len(assets)
+                assets_per_second = num_assets / max(time.monotonic() - start_time, 1e-6)
+                self.progress.update(progress_task, f"Listed {num_assets} assets, looked up {num_blueprints_fetched} blueprints ({assets_per_second:.1f} assets/s)")
+
+                if self.test_mode and num_assets >= TEST_LIMIT:
+                    break
+
+        self.send_to_log(f"Prefetched {num_assets} assets of {token_address} in {time.monotonic() - start_time:.0f} seconds, looking up {num_blueprints_fetched} blueprints")
+
+        await self.progress.finish(progress_task)
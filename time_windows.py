@@ -0,0 +1,71 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+from models import Asset, Transfer, Mint, EXPORT_CHUNK_SIZE
+from utils import to_epoch
+
+RELATIVE_TIME = re.compile(r"^(\d+)([dhm])$")  # e.g. "30d" is 30 days before the job runs
+RELATIVE_UNITS = {"d": "days", "h": "hours", "m": "minutes"}
+
+
+def parse_window_time(value: str, now: datetime | None = None) -> int:
+    # "30d", "12h" and "90m" are that long before now. Anything else is an ISO 8601 date or time, in UTC unless it has
+    # an offset. Returns microseconds since the Unix epoch, to compare with the *_epoch columns
+    value = value.strip()
+    match = RELATIVE_TIME.match(value)
+    if match:
+        now = datetime.now(timezone.utc) if now is None else now
+        return to_epoch(now - timedelta(**{RELATIVE_UNITS[match[2]]: int(match[1])}))
+    try:
+        return to_epoch(datetime.fromisoformat(value))
+    except ValueError:
+        raise ValueError(f"Expected a time like 30d, 12h, 2024-01-01 or 2024-01-01T12:00:00Z, got {value!r}")
+
+
+def check_window(since: str | None, until: str | None) -> None:
+    # Fails when the job is created rather than when it runs
+    for value in (since, until):
+        if value:
+            parse_window_time(value)
+
+
+def describe_window(since: str | None, until: str | None) -> str:
+    if since and until:
+        return f"from {since} until {until}"
+    return f"since {since}" if since else f"until {until}"
+
+
+def get_window_filters(field: str, since: str | None, until: str | None) -> dict:
+    # Filters on an *_epoch field for since <= time < until. Relative times are taken from when this is called
+    filters = {}
+    if since:
+        filters[f"{field}__gte"] = parse_window_time(since)
+    if until:
+        filters[f"{field}__lt"] = parse_window_time(until)
+    return filters
+
+
+async def fetch_assets(records: list[Transfer] | list[Mint]) -> list[Asset]:
+    for start in range(0, len(records), EXPORT_CHUNK_SIZE):
+        await type(records[start]).fetch_for_list(records[start:start + EXPORT_CHUNK_SIZE], "asset")
+    return [record.asset for record in records]
+
+
+async def get_user_transfers_in_window(user_address: str, direction: str, since: str | None, until: str | None) -> tuple[list[Transfer], list[Asset]]:
+    address_filter = {"user": user_address} if direction == "out" else {"receiver": user_address}
+    transfers = await Transfer.filter(**address_filter, **get_window_filters("timestamp_epoch", since, until)).order_by("timestamp_epoch", "transaction_id")
+    return transfers, await fetch_assets(transfers)
+
+
+async def get_minted_assets_in_window(user_address: str, since: str | None, until: str | None) -> list[Asset]:
+    mints = await Mint.filter(user=user_address, **get_window_filters("timestamp_epoch", since, until)).order_by("timestamp_epoch", "transaction_id")
+    return await fetch_assets(mints)
+
+
+async def iterate_asset_transfers_in_window(asset_ids: list[str], since: str | None, until: str | None):
+    # Yields the transfers of a chunk of the assets at a time
+    window_filters = get_window_filters("timestamp_epoch", since, until)
+    for start in range(0, len(asset_ids), EXPORT_CHUNK_SIZE):
+        transfers = await Transfer.filter(asset_id__in=asset_ids[start:start + EXPORT_CHUNK_SIZE], **window_filters).order_by("timestamp_epoch", "transaction_id")
+        if transfers:
+            yield transfers
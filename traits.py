@@ -0,0 +1,76 @@
+from tortoise.expressions import Subquery
+from tortoise.functions import Count
+
+from models import Asset, Trait
+
+COLLECTION_KEY = "token_address"  # In a trait query, limits the search to one collection rather than matching a trait
+
+
+def parse_trait_query(query: str) -> tuple[dict[str, str], str | None]:
+    # "rarity=Legendary; token_address=0xabc" -> ({"rarity": "Legendary"}, "0xabc"). Pairs are split on ";" because
+    # trait values can contain commas
+    traits = {}
+    token_address = None
+    for pair in query.split(";"):
+        if not pair.strip():
+            continue
+        key, separator, value = pair.partition("=")
+        if not separator:
+            raise ValueError(f"Expected key=value in trait query, got {pair.strip()!r}")
+        if key.strip() == COLLECTION_KEY:
+            token_address = value.strip()
+        else:
+            traits[key.strip()] = value.strip()
+    if not traits and token_address is None:
+        raise ValueError("A trait query needs at least one key=value pair")
+    return traits, token_address
+
+
+def filter_traits(token_address: str | None = None, **filters):
+    queryset = Trait.filter(**filters)
+    if token_address is not None:
+        queryset = queryset.filter(token_address=token_address)
+    return queryset
+
+
+def filter_assets_by_traits(traits: dict[str, str], token_address: str | None = None):
+    # Assets that have every one of the traits. Each trait is its own indexed subquery, since filtering the reverse
+    # relation twice would only match a single trait row holding both values
+    queryset = Asset.all()
+    if token_address is not None:
+        queryset = queryset.filter(token_address=token_address)
+    for key, value in traits.items():
+        queryset = queryset.filter(id__in=Subquery(filter_traits(token_address, key=key, value=value).values("asset_id")))
+    return queryset
+
+
+async def find_assets_by_traits(traits: dict[str, str], token_address: str | None = None) -> list[Asset]:
+    return await filter_assets_by_traits(traits, token_address).order_by("id")
+
+
+async def iterate_assets_by_traits(traits: dict[str, str], token_address: str | None = None, page_size: int = 200):
+    # Pages of find_assets_by_traits, read by id so each page is one indexed query
+    last_id = ""
+    while True:
+        assets = await filter_assets_by_traits(traits, token_address).filter(id__gt=last_id).order_by("id").limit(page_size)
+        if not assets:
+            return
+        yield assets
+        last_id = assets[-1].id
+
+
+async def get_trait_counts(token_address: str | None = None, key: str | None = None) -> list[dict]:
+    # How many assets have each trait value, and what share of the assets with that trait key they make up
+    filters = {} if key is None else {"key": key}
+    counts = await (
+        filter_traits(token_address, **filters)
+        .annotate(count=Count("id"))
+        .group_by("key", "value")
+        .order_by("key", "value")
+        .values("key", "value", "count")
+    )
+    key_totals = {}
+    for row in await filter_traits(token_address, **filters).annotate(count=Count("asset_id", distinct=True)).group_by("key").values("key", "count"):
+        key_totals[row["key"]] = row["count"]
+
+    return [row | {"share": row["count"] / key_totals[row["key"]]} for row in counts]
@@ -2,15 +2,22 @@ import os
 import sys
 from pathlib import Path
 from tortoise import Tortoise, run_async
-from datetime import datetime
 
 from textual import on, work
 from textual.app import App, ComposeResult
 from textual.widgets import Header, Static, Input, Select, Button, RichLog, Checkbox
+from rich.text import Text
 
-from searches import Searcher
-from utils import create_dir_if_not_exist, write_list_of_tortoise_objects_to_csv, write_list_of_dicts_to_csv, \
-    create_transfer_summaries, create_transfer_output_files, log_exceptions
+from db import setup_db, DB_PATH
+from jobs import create_job, describe_job, run_job, run_queued_jobs, resume_job, mark_interrupted_jobs, DEFAULT_ASSET_NAME, DEFAULT_USER_ADDRESS
+from models import Job
+from progress import TuiProgressReporter
+from response_cache import ResponseCache, RESPONSE_CACHE_DIR
+from searches import Searcher, DEFAULT_PREFETCH_WORKERS
+from time_windows import check_window
+from utils import create_dir_if_not_exist, log_exceptions, check_output_format, check_summary_layout, DEFAULT_SUMMARY_LAYOUT
+
+JOB_LIST_LENGTH = 20
 
 
 class ImxApp(App):
@@ -20,111 +27,183 @@ class ImxApp(App):
     def __init__(self, *args, **kwargs):
         self.output_dir = kwargs["output_dir"]
         self.test_mode = kwargs["test_mode"]
-        self.searcher = Searcher(self, self.test_mode)
+        self.profile = kwargs.pop("profile", False)
+        self.searcher = Searcher(TuiProgressReporter(self), self.test_mode, kwargs.pop("http2", False), response_cache=kwargs.pop("response_cache", None))
         del kwargs["output_dir"]
         del kwargs["test_mode"]
         super().__init__(*args, **kwargs)
 
-    @on(Button.Pressed, "#run_asset_search")
-    async def on_asset_search(self, event: Button.Pressed) -> None:
-        async with log_exceptions(self):
-            self.asset_search()
+    def get_output_format(self) -> str:
+        output_format = self.query_one("#output_format", Select).value
+        if output_format is None:
+            output_format = "csv"
+        check_output_format(output_format)  # Fails before the search rather than after it
+        return output_format
 
-    @work(exclusive=True)
-    async def asset_search(self) -> None:
+    def get_asset_search_parameters(self) -> dict:
         asset_name_box = self.query_one("#asset_name", Input)
         original_asset_name = asset_name_box.value
         if original_asset_name == "":
-            original_asset_name = "#100 Todd McFarlane Batman"
+            original_asset_name = DEFAULT_ASSET_NAME
 
         search_type_box = self.query_one("#search_type", Select)
         search_type = search_type_box.value
 
-        if search_type == "metadata":
-            asset_name = original_asset_name.replace(" ", "_")
-        else:
-            asset_name = original_asset_name
+        output_format = self.get_output_format()
+        return {"original_asset_name": original_asset_name, "search_type": search_type, "output_format": output_format} | self.get_window_parameters()
 
-        self.searcher.send_to_log(f"Getting asset data for {original_asset_name}")
+    def get_user_search_parameters(self) -> dict:
+        user_address = self.query_one("#user_address", Input).value
+        if user_address == "":
+            user_address = DEFAULT_USER_ADDRESS
+
+        return {
+            "user_address": user_address,
+            "output_format": self.get_output_format(),
+            "get_transfers_out": self.query_one("#transfers_out", Checkbox).value,
+            "get_transfers_in": self.query_one("#transfers_in", Checkbox).value,
+            "get_mints": self.query_one("#mints", Checkbox).value,
+            "get_first_non_mint": self.query_one("#first_non_mint", Checkbox).value,
+            "incremental": self.query_one("#incremental", Checkbox).value,
+            "summary_layout": self.get_summary_layout(),
+        } | self.get_window_parameters()
+
+    def get_summary_layout(self) -> str:
+        summary_layout = self.query_one("#summary_layout", Select).value
+        if summary_layout is None:
+            summary_layout = DEFAULT_SUMMARY_LAYOUT
+        check_summary_layout(summary_layout)
+        return summary_layout
+
+    def get_window_parameters(self) -> dict:
+        since = self.query_one("#since", Input).value or None
+        until = self.query_one("#until", Input).value or None
+        check_window(since, until)
+        return {"since": since, "until": until}
+
+    def get_blueprint_prefetch_parameters(self) -> dict:
+        token_address = self.query_one("#token_address", Input).value
 
-        assets, transfers = await self.searcher.asset_search(asset_name, search_type)
+        starting_token_id = self.query_one("#starting_token_id", Input).value
+        if starting_token_id == "":
+            starting_token_id = 1
+        else:
+            starting_token_id = int(starting_token_id)
 
-        self.searcher.send_to_log(f"Data collected, creating outputs")
+        ending_token_id = self.query_one("#ending_token_id", Input).value
+        if ending_token_id == "":
+            ending_token_id = 100
+        else:
+            ending_token_id = int(ending_token_id)
 
-        file_prefix = f'{datetime.now().strftime("%Y%m%d_%H%M")} {original_asset_name}'
-        await write_list_of_tortoise_objects_to_csv(self.output_dir / f"{file_prefix} assets.csv", assets)
-        await write_list_of_tortoise_objects_to_csv(self.output_dir / f"{file_prefix} transfers.csv", transfers)
+        num_workers = self.query_one("#num_workers", Input).value
+        if num_workers == "":
+            num_workers = DEFAULT_PREFETCH_WORKERS
+        else:
+            num_workers = int(num_workers)
 
-        self.searcher.send_to_log(f"Job complete")
+        bulk = self.query_one("#bulk", Checkbox).value
 
-    @on(Button.Pressed, "#run_user_search")
-    async def on_user_search(self, event: Button.Pressed) -> None:
-        async with log_exceptions(self):
-            self.user_search()
+        return {"token_address": token_address, "starting_token_id": starting_token_id, "ending_token_id": ending_token_id, "num_workers": num_workers, "bulk": bulk}
 
     @work(exclusive=True)
-    async def user_search(self) -> None:
-        user_address = self.query_one("#user_address", Input).value
-        if user_address == "":
-            user_address = "0x7be178ba43a9828c22997a3ec3640497d88d2fd3"
-
-        get_transfers_out = self.query_one("#transfers_out", Checkbox).value
-        get_transfers_in = self.query_one("#transfers_in", Checkbox).value
-        get_mints = self.query_one("#mints", Checkbox).value
-        get_first_non_mint = self.query_one("#first_non_mint", Checkbox).value
+    async def run_new_job(self, job_type: str, parameters: dict) -> None:
+        # Every search is saved as a job, so one that crashes or is stopped can be resumed from the job queue
+        job = await create_job(job_type, parameters, status="running")
+        await run_job(self.searcher, job, self.output_dir, self.profile)
+        self.searcher.log_cache_stats()
 
-        file_prefix = f'{datetime.now().strftime("%Y%m%d_%H%M")} {user_address}'
+    async def queue_job(self, job_type: str, parameters: dict) -> None:
+        job = await create_job(job_type, parameters)
+        self.searcher.send_to_log(f"Queued {describe_job(job)}")
 
-        if get_transfers_out:
-            transfer_out_history, assets_transferred_out = await self.searcher.get_transfer_history_of_user(user_address, "out", get_first_non_mint)
-            await create_transfer_output_files(transfer_out_history, assets_transferred_out, 'out', self.output_dir, file_prefix)
+    @on(Button.Pressed, "#run_asset_search")
+    async def on_asset_search(self, event: Button.Pressed) -> None:
+        async with log_exceptions(self):
+            self.run_new_job("asset", self.get_asset_search_parameters())
 
-        if get_transfers_in:
-            transfer_in_history, assets_transferred_in = await self.searcher.get_transfer_history_of_user(user_address, "in", get_first_non_mint)
-            await create_transfer_output_files(transfer_in_history, assets_transferred_in, 'in', self.output_dir, file_prefix)
+    @on(Button.Pressed, "#queue_asset_search")
+    async def on_queue_asset_search(self, event: Button.Pressed) -> None:
+        async with log_exceptions(self):
+            await self.queue_job("asset", self.get_asset_search_parameters())
 
-        if get_mints:
-            mints = await self.searcher.get_minted_assets(user_address, get_first_non_mint)
-            await write_list_of_tortoise_objects_to_csv(self.output_dir / f"{file_prefix} minted assets.csv", mints)
+    @on(Button.Pressed, "#run_user_search")
+    async def on_user_search(self, event: Button.Pressed) -> None:
+        async with log_exceptions(self):
+            self.run_new_job("user", self.get_user_search_parameters())
 
-        self.searcher.send_to_log(f"Job complete")
+    @on(Button.Pressed, "#queue_user_search")
+    async def on_queue_user_search(self, event: Button.Pressed) -> None:
+        async with log_exceptions(self):
+            await self.queue_job("user", self.get_user_search_parameters())
 
     @on(Button.Pressed, "#run_blueprint_prefetch")
     async def on_blueprint_prefetch(self, event: Button.Pressed) -> None:
         async with log_exceptions(self):
-            self.blueprint_prefetch()
-
-    @work(exclusive=True)
-    async def blueprint_prefetch(self) -> None:
-        self.searcher.send_to_log(f"Prefetching blueprints")
-        token_address = self.query_one("#token_address", Input).value
+            self.run_new_job("prefetch", self.get_blueprint_prefetch_parameters())
 
-        starting_token_id = self.query_one("#starting_token_id", Input).value
-        if starting_token_id == "":
-            starting_token_id = 1
-        else:
-            starting_token_id = int(starting_token_id)
+    @on(Button.Pressed, "#queue_blueprint_prefetch")
+    async def on_queue_blueprint_prefetch(self, event: Button.Pressed) -> None:
+        async with log_exceptions(self):
+            await self.queue_job("prefetch", self.get_blueprint_prefetch_parameters())
+
+    async def show_jobs(self) -> None:
+        jobs = await Job.all().order_by("-id").limit(JOB_LIST_LENGTH)
+        job_list = "\n".join(describe_job(job) for job in jobs) or "No jobs yet"
+        self.query_one("#job_list", Static).update(Text(job_list))
+
+    def start_queue(self) -> None:
+        # The queue runs in its own worker group, so starting it doesn't cancel a search that is running. A running
+        # queue picks up jobs queued while it runs, so a second one is never started
+        if any(worker.group == "queue" and worker.is_running for worker in self.workers):
+            self.searcher.send_to_log("The job queue is already running; queued jobs will run after the current one")
+            return
+        self.run_queue()
+
+    @work(group="queue")
+    async def run_queue(self) -> None:
+        num_failed = await run_queued_jobs(self.searcher, self.output_dir, self.profile)
+        self.searcher.send_to_log(f"Job queue finished ({num_failed} failed)")
+        self.searcher.log_cache_stats()
+        if self.query("#job_list"):
+            await self.show_jobs()
+
+    @on(Button.Pressed, "#run_queue")
+    async def on_run_queue(self, event: Button.Pressed) -> None:
+        async with log_exceptions(self):
+            self.start_queue()
 
-        ending_token_id = self.query_one("#ending_token_id", Input).value
-        if ending_token_id == "":
-            ending_token_id = 100
-        else:
-            ending_token_id = int(ending_token_id)
+    @on(Button.Pressed, "#resume_job")
+    async def on_resume_job(self, event: Button.Pressed) -> None:
+        async with log_exceptions(self):
+            job = await resume_job(int(self.query_one("#job_id", Input).value))
+            self.searcher.send_to_log(f"Resuming {describe_job(job)}")
+            await self.show_jobs()
+            self.start_queue()
 
-        await self.searcher.blueprint_prefetch(token_address, starting_token_id, ending_token_id)
-        self.searcher.send_to_log(f"Job complete")
+    @on(Button.Pressed, "#refresh_jobs")
+    async def on_refresh_jobs(self, event: Button.Pressed) -> None:
+        async with log_exceptions(self):
+            await self.show_jobs()
 
     def compose(self) -> ComposeResult:
         yield Header(id="header")
         yield Drawer(id="drawer")
         yield RichLog(id="log")
+        yield Static("Metrics", id="metrics")
         yield Static("Progress", id="progress")
 
     async def action_quit(self) -> None:
+        await self.searcher.close()
         await Tortoise.close_connections()
         self.exit()
 
 
+async def setup(db_path: str) -> None:
+    await setup_db(db_path)
+    await mark_interrupted_jobs()
+
+
 class Drawer(Static):
     @on(Select.Changed, "#analysis_type")
     async def on_analysis_type_change(self, event: Select.Changed) -> None:
@@ -136,17 +215,34 @@ class Drawer(Static):
         await self.query("#transfers_in").remove()
         await self.query("#mints").remove()
         await self.query("#first_non_mint").remove()
+        await self.query("#incremental").remove()
+        await self.query("#summary_layout").remove()
         await self.query("#run_user_search").remove()
         await self.query("#token_address").remove()
         await self.query("#starting_token_id").remove()
         await self.query("#ending_token_id").remove()
+        await self.query("#num_workers").remove()
+        await self.query("#bulk").remove()
         await self.query("#run_blueprint_prefetch").remove()
+        await self.query("#queue_asset_search").remove()
+        await self.query("#queue_user_search").remove()
+        await self.query("#queue_blueprint_prefetch").remove()
+        await self.query("#job_list").remove()
+        await self.query("#job_id").remove()
+        await self.query("#resume_job").remove()
+        await self.query("#run_queue").remove()
+        await self.query("#refresh_jobs").remove()
+        await self.query("#since").remove()
+        await self.query("#until").remove()
 
         if event.value == "asset":
             await self.mount(
-        Input(placeholder="Asset name", id="asset_name"),
-                Select(prompt="Search type", options=[("By blueprint", "blueprint"), ("By metadata name", "metadata")], id="search_type"),
+        Input(placeholder="Asset name, or key=value; key=value for a trait search", id="asset_name"),
+                Select(prompt="Search type", options=[("By blueprint", "blueprint"), ("By metadata name", "metadata"), ("By trait (local)", "trait")], id="search_type"),
+                Input(placeholder="Only export transfers since, e.g. 30d or 2024-01-01", id="since"),
+                Input(placeholder="Only export transfers until", id="until"),
                 Button("Run search", variant="primary", id="run_asset_search"),
+                Button("Add to queue", id="queue_asset_search"),
             )
 
         elif event.value == "user":
@@ -156,29 +252,46 @@ class Drawer(Static):
                 Checkbox("Get transfers in", id="transfers_in", value=True),
                 Checkbox("Get mints", id="mints", value=True),
                 Checkbox("Get get first non-mint user", id="first_non_mint", value=True),
+                Checkbox("Only fetch records newer than the last search", id="incremental", value=False),
+                Select(prompt="Counts by user layout", options=[("Wide (user x blueprint)", "wide"), ("Long (row per user and blueprint)", "long"), ("Sparse (wide, for large searches)", "sparse")], value=DEFAULT_SUMMARY_LAYOUT, id="summary_layout"),
+                Input(placeholder="Only export records since, e.g. 30d or 2024-01-01", id="since"),
+                Input(placeholder="Only export records until", id="until"),
                 Button("Run search", variant="primary", id="run_user_search"),
+                Button("Add to queue", id="queue_user_search"),
             )
         elif event.value == "blueprint_prefetch":
             await self.mount(
                 Input(placeholder="User address", id="token_address", value="0xa7aefead2f25972d80516628417ac46b3f2604af"),
                 Input(placeholder="Starting token id", id="starting_token_id"),
                 Input(placeholder="Ending token id", id="ending_token_id"),
+                Input(placeholder=f"Number of workers (default {DEFAULT_PREFETCH_WORKERS})", id="num_workers"),
+                Checkbox("List the whole collection (ignores the token ids)", id="bulk", value=False),
                 Button("Run search", variant="primary", id="run_blueprint_prefetch"),
+                Button("Add to queue", id="queue_blueprint_prefetch"),
             )
+        elif event.value == "jobs":
+            await self.mount(
+                Static(id="job_list"),
+                Button("Refresh", id="refresh_jobs"),
+                Input(placeholder="Job id", id="job_id"),
+                Button("Resume job", variant="primary", id="resume_job"),
+                Button("Run queued jobs", variant="primary", id="run_queue"),
+            )
+            await self.app.show_jobs()
 
     def compose(self) -> ComposeResult:
-        yield Select(prompt="Analysis type", options=[("Asset search", "asset"), ("User search", "user"), ("Blueprint prefetch", "blueprint_prefetch")], id="analysis_type")
-
-
-async def setup_db():
-    await Tortoise.init(db_url="sqlite://db.sqlite3", modules={"models": ["models"]})
-    await Tortoise.generate_schemas()
+        yield Select(prompt="Analysis type", options=[("Asset search", "asset"), ("User search", "user"), ("Blueprint prefetch", "blueprint_prefetch"), ("Job queue", "jobs")], id="analysis_type")
+        yield Select(prompt="Output format", options=[("CSV", "csv"), ("Parquet", "parquet")], value="csv", id="output_format")
 
 
 if __name__ == "__main__":
     test_mode = os.environ.get("IMX_TEST_MODE") == "1"
+    http2 = os.environ.get("IMX_HTTP2") == "1"  # Requires the h2 package
+    profile = os.environ.get("IMX_PROFILE") == "1"  # Writes a cProfile .prof file next to each job's outputs
+    response_cache_dir = os.environ.get("IMX_RESPONSE_CACHE", RESPONSE_CACHE_DIR)  # Set to "" to turn the cache off
+    response_cache = ResponseCache(response_cache_dir, offline=os.environ.get("IMX_OFFLINE") == "1") if response_cache_dir else None
     output_dir = Path() / "output"
     create_dir_if_not_exist(output_dir)
-    run_async(setup_db())
-    app = ImxApp(output_dir=output_dir, test_mode=test_mode)
+    run_async(setup(os.environ.get("IMX_DB_PATH", DB_PATH)))
+    app = ImxApp(output_dir=output_dir, test_mode=test_mode, http2=http2, response_cache=response_cache, profile=profile)
     app.run()
@@ -1,11 +1,69 @@
 import csv
-from contextlib import asynccontextmanager
+import json
+import tempfile
+from contextlib import asynccontextmanager, aclosing
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from typing import AsyncIterable, AsyncIterator
 import pandas as pd
 from textual.widgets import RichLog
 from rich.traceback import Traceback
 
-from models import Transfer, Asset
+from api_models import loads
+from metrics import get_metrics
+from models import Transfer, Asset, EXPORT_CHUNK_SIZE
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is optional
+    pa = None
+    pq = None
+
+OUTPUT_FORMATS = ("csv", "parquet")
+# Shapes of the "counts by user" summary: wide is a user x blueprint table of counts, long is a row per user and
+# blueprint with the other aggregates too, and sparse is wide without storing the zeros, for many users and blueprints
+SUMMARY_LAYOUTS = ("wide", "long", "sparse")
+DEFAULT_SUMMARY_LAYOUT = "wide"
+
+# Fixed Parquet columns for each exported model. Any other keys in a row (i.e. asset metadata) go into the json column
+ASSET_PARQUET_COLUMNS = {
+    "id": "string",
+    "token_address": "string",
+    "token_id": "string",
+    "user": "string",
+    "status": "string",
+    "uri": "string",
+    "name": "string",
+    "description": "string",
+    "image_url": "string",
+    "collection": "string",
+    "created_at": "timestamp",
+    "updated_at": "timestamp",
+    "blueprint": "string",
+    "blueprint_name": "string",
+    "blueprint_edition": "string",
+    "mint_address": "string",
+    "first_non_mint_address": "string",
+    "checked_first_non_mint_address": "bool",
+    "num_transfers": "int",
+    "metadata": "json",
+}
+TRANSFER_PARQUET_COLUMNS = {
+    "receiver": "string",
+    "status": "string",
+    "timestamp": "timestamp",
+    "transaction_id": "int",
+    "user": "string",
+    "asset_token_address": "string",
+    "asset_token_id": "string",
+    "asset_blueprint": "string",
+    "asset_blueprint_name": "string",
+    "asset_blueprint_edition": "string",
+}
+PARQUET_COLUMNS = {Asset: ASSET_PARQUET_COLUMNS, Transfer: TRANSFER_PARQUET_COLUMNS}
+# Models whose rows always have the same keys, so their CSVs are written as the rows arrive instead of spooled first
+CSV_FIELDNAMES = {Transfer: list(TRANSFER_PARQUET_COLUMNS)}
 
 
 def create_dir_if_not_exist(dir_: Path) -> None:
@@ -29,36 +87,326 @@ def write_list_of_dicts_to_csv(path, dict_list):
         writer.writerows(dict_list)
 
 
+async def write_rows_to_csv(path, rows: AsyncIterable[dict], fieldnames: list[str] | None = None) -> None:
+    if fieldnames is not None:
+        # Known schema, so rows can go straight to the file
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            async for row in rows:
+                writer.writerow(row)
+        return
+
+    # Columns can first appear on any row (metadata keys vary per asset), so spool the rows to disk while collecting
+    # the header, then copy them into the CSV once all columns are known
+    all_keys: dict[str, None] = {}
+    with tempfile.TemporaryFile("w+", encoding="utf-8", dir=Path(path).parent) as spool:
+        async for row in rows:
+            all_keys.update(dict.fromkeys(row))
+            spool.write(json.dumps(row, default=str) + "\n")
+
+        spool.seek(0)
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(all_keys))
+            writer.writeheader()
+            for line in spool:
+                writer.writerow(loads(line))
+
+
+def parse_timestamp(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    return datetime.fromisoformat(value)
+
+
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_epoch(value: str | datetime | None) -> int | None:
+    # Microseconds since the Unix epoch, as stored in the *_epoch columns. Times without an offset are taken as UTC
+    if isinstance(value, str):
+        value = parse_timestamp(value)
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - UNIX_EPOCH) // timedelta(microseconds=1)
+
+
+def get_parquet_type(column_type: str):
+    return {
+        "string": pa.string(),
+        "json": pa.string(),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "bool": pa.bool_(),
+    }[column_type]
+
+
+def to_parquet_row(row: dict, columns: dict[str, str]) -> dict:
+    parquet_row = {}
+    for column, column_type in columns.items():
+        if column_type == "json":
+            parquet_row[column] = json.dumps({key: value for key, value in row.items() if key not in columns}, default=str)
+            continue
+
+        value = row.get(column)
+        if value is None:
+            parquet_row[column] = None
+        elif column_type == "timestamp":
+            parquet_row[column] = parse_timestamp(value)
+        elif column_type == "int":
+            parquet_row[column] = int(value)
+        elif column_type == "bool":
+            parquet_row[column] = bool(value)
+        else:
+            parquet_row[column] = str(value)
+    return parquet_row
+
+
+def to_parquet_frame(df: pd.DataFrame, columns: dict[str, str]) -> pd.DataFrame:
+    # to_parquet_row for a DataFrame. Timestamp columns hold the text timestamps, as the CSV writes them
+    df = df[list(columns)]
+    return df.assign(**{column: pd.to_datetime(df[column], utc=True) for column, column_type in columns.items() if column_type == "timestamp"})
+
+
+def check_output_format(output_format: str) -> None:
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format}; expected one of {OUTPUT_FORMATS}")
+    if output_format == "parquet" and pa is None:
+        raise RuntimeError("Parquet output requires pyarrow (pip install pyarrow)")
+
+
+def check_summary_layout(layout: str) -> None:
+    if layout not in SUMMARY_LAYOUTS:
+        raise ValueError(f"Unknown summary layout {layout}; expected one of {SUMMARY_LAYOUTS}")
+
+
+def get_output_path(output_dir: Path, name: str, output_format: str) -> Path:
+    return output_dir / f"{name}.{output_format}"
+
+
+async def write_rows_to_parquet(path, rows: AsyncIterable[dict], columns: dict[str, str]) -> None:
+    check_output_format("parquet")
+    schema = pa.schema([(column, get_parquet_type(column_type)) for column, column_type in columns.items()])
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        batch = []
+        async for row in rows:
+            batch.append(to_parquet_row(row, columns))
+            if len(batch) >= EXPORT_CHUNK_SIZE:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+
+
+async def write_rows(path, rows: AsyncIterable[dict], model, output_format: str = "csv") -> None:
+    check_output_format(output_format)
+    metrics = get_metrics()
+    rows = metrics.count_rows("export", rows)
+    with metrics.timed("export"):
+        if output_format == "parquet":
+            await write_rows_to_parquet(path, rows, PARQUET_COLUMNS[model])
+        else:
+            await write_rows_to_csv(path, rows, CSV_FIELDNAMES.get(model))
+
+
+def write_dataframe(df: pd.DataFrame, path, output_format: str = "csv") -> None:
+    check_output_format(output_format)
+    with get_metrics().timed("export", rows=len(df)):
+        # Parquet can't hold sparse columns and CSV only writes them through a deprecated cast, so the sparse summary
+        # layout is written dense, a column at a time
+        sparse_columns = [column for column, dtype in df.dtypes.items() if isinstance(dtype, pd.SparseDtype)]
+        if sparse_columns:
+            df = df.copy()
+            for column in sparse_columns:
+                df[column] = df[column].sparse.to_dense()
+        if output_format == "parquet":
+            # Parquet needs plain string column names, but pivoted summaries are keyed by blueprint name categories
+            df = df.set_axis([str(column) for column in df.columns], axis=1)
+            df.to_parquet(path, compression="zstd")
+        else:
+            df.to_csv(path)
+
+
+async def write_dataframe_pages(pages: AsyncIterable[pd.DataFrame], path, output_format: str, columns: dict[str, str]) -> None:
+    # Writes DataFrames with the same columns one after another, as write_dataframe would write them concatenated
+    # with a fresh index. columns gives the Parquet type of each column, as one page can't be relied on to show it
+    check_output_format(output_format)
+    metrics = get_metrics()
+    num_rows = 0
+    async with aclosing(pages) as pages:
+        if output_format == "parquet":
+            schema = pa.schema([(column, get_parquet_type(column_type)) for column, column_type in columns.items()])
+            with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+                async for df in pages:
+                    with metrics.timed("export", rows=len(df)):
+                        writer.write_table(pa.Table.from_pandas(to_parquet_frame(df, columns), schema=schema, preserve_index=False))
+        else:
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                pd.DataFrame(columns=list(columns)).to_csv(f)
+                async for df in pages:
+                    with metrics.timed("export", rows=len(df)):
+                        df[list(columns)].set_axis(range(num_rows, num_rows + len(df))).to_csv(f, header=False)
+                    num_rows += len(df)
+
+
+async def iterate_list(list_) -> AsyncIterator:
+    for item in list_:
+        yield item
+
+
+async def tortoise_objects_to_dicts(object_list) -> list[dict]:
+    if not object_list:
+        return []
+    return await type(object_list[0]).to_dicts(object_list)
+
+
+async def iterate_tortoise_object_rows(object_list) -> AsyncIterator[dict]:
+    # Only one chunk of row dicts exists at a time
+    for start in range(0, len(object_list), EXPORT_CHUNK_SIZE):
+        for row in await tortoise_objects_to_dicts(object_list[start:start + EXPORT_CHUNK_SIZE]):
+            yield row
+
+
+async def iterate_page_rows(pages: AsyncIterable[list]) -> AsyncIterator[dict]:
+    # Rows of pages of ORM objects as a search yields them, e.g. from Searcher.iterate_minted_assets
+    async with aclosing(pages) as pages:
+        async for page in pages:
+            for row in await tortoise_objects_to_dicts(page):
+                yield row
+
+
+async def iterate_objects_by_id(model, ids: list) -> AsyncIterator[list]:
+    # Pages of the model's objects with the given primary keys, in the order given, loaded a chunk at a time
+    for start in range(0, len(ids), EXPORT_CHUNK_SIZE):
+        chunk = ids[start:start + EXPORT_CHUNK_SIZE]
+        objects = {obj.pk: obj for obj in await model.filter(pk__in=chunk)}
+        yield [objects[pk] for pk in chunk if pk in objects]
+
+
 async def write_list_of_tortoise_objects_to_csv(path, object_list):
-    object_dicts = [await obj.to_dict() for obj in object_list]
-    write_list_of_dicts_to_csv(path, object_dicts)
+    await write_rows_to_csv(path, iterate_tortoise_object_rows(object_list))
 
 
-async def create_transfer_summaries(transfer_dicts, direction) -> tuple[pd.DataFrame, pd.DataFrame]:
-    transfers_df = pd.DataFrame(transfer_dicts)
+def get_summary_index_col(direction: str) -> str:
+    # The other party of each transfer, who the "counts by user" summary is by
+    return 'receiver' if direction == 'out' else 'user'
+
+
+def get_transfer_chunk_summary(transfer_dicts, index_col: str) -> pd.DataFrame:
+    # Count and first and last timestamps of a chunk of transfer row dicts per user, blueprint and asset. Summaries of
+    # several chunks add up with merge_transfer_chunk_summaries, and the distinct assets are counted from the merged one.
+    # Object columns keep an empty chunk (e.g. no transfers in a direction or window) from being inferred as float64
+    transfers_df = pd.DataFrame(transfer_dicts, columns=['asset_blueprint_name', index_col, 'timestamp', 'asset_token_address', 'asset_token_id'], dtype=object)
+    transfers_df['asset'] = transfers_df['asset_token_address'] + '-' + transfers_df['asset_token_id']
+    transfers_df['timestamp'] = pd.to_datetime(transfers_df['timestamp'], utc=True)
+    # dropna=False keeps transfers with a missing key in the counts, as the final grouping decides which to drop
+    return transfers_df.groupby([index_col, 'asset_blueprint_name', 'asset'], dropna=False).agg(
+        count=('timestamp', 'size'),
+        first_timestamp=('timestamp', 'min'),
+        last_timestamp=('timestamp', 'max'),
+    ).reset_index()
+
+
+def merge_transfer_chunk_summaries(chunk_summaries: list[pd.DataFrame], index_col: str) -> pd.DataFrame:
+    return pd.concat(chunk_summaries, ignore_index=True).groupby([index_col, 'asset_blueprint_name', 'asset'], dropna=False).agg(
+        count=('count', 'sum'),
+        first_timestamp=('first_timestamp', 'min'),
+        last_timestamp=('last_timestamp', 'max'),
+    ).reset_index()
+
+
+async def create_transfer_summaries(transfer_dicts, direction, layout: str = DEFAULT_SUMMARY_LAYOUT) -> tuple[pd.DataFrame, pd.DataFrame]:
+    index_col = get_summary_index_col(direction)
+    return await create_transfer_summaries_from_chunk_summary(get_transfer_chunk_summary(transfer_dicts, index_col), direction, layout)
 
-    transfers_df['ones'] = 1
-    if direction == 'out':
-        index_col = 'receiver'
-    else:
-        index_col = 'user'
 
-    reduced_transfers_df = transfers_df[['asset_blueprint_name', index_col, 'ones']]
-    transfer_counts_by_user = pd.pivot_table(reduced_transfers_df, index=index_col, columns='asset_blueprint_name', values='ones', aggfunc='count')
+async def create_transfer_summaries_from_chunk_summary(chunk_summary: pd.DataFrame, direction, layout: str = DEFAULT_SUMMARY_LAYOUT) -> tuple[pd.DataFrame, pd.DataFrame]:
+    index_col = get_summary_index_col(direction)
+    summary_df = chunk_summary.copy()
+    # Categoricals keep the repeated addresses and names as integer codes, and let groupby skip empty combinations
+    for column in (index_col, 'asset_blueprint_name', 'asset'):
+        summary_df[column] = summary_df[column].astype('category')
 
-    transfer_counts = reduced_transfers_df[['asset_blueprint_name', 'ones']].groupby('asset_blueprint_name').sum().rename(columns={'ones': 'count'})
+    aggregates = dict(
+        count=('count', 'sum'),
+        first_timestamp=('first_timestamp', 'min'),
+        last_timestamp=('last_timestamp', 'max'),
+        distinct_assets=('asset', 'nunique'),
+    )
+    transfer_summary_by_user = summary_df.groupby([index_col, 'asset_blueprint_name'], observed=True).agg(**aggregates).sort_index()
+    transfer_counts = summary_df.groupby('asset_blueprint_name', observed=True).agg(**aggregates).sort_index()
+
+    if layout == "long":
+        transfer_counts_by_user = transfer_summary_by_user
+    elif layout == "wide":
+        transfer_counts_by_user = transfer_summary_by_user['count'].unstack('asset_blueprint_name')
+    elif layout == "sparse":
+        # Built one blueprint column at a time, so the dense user x blueprint matrix never exists
+        users = transfer_summary_by_user.index.get_level_values(0).unique()
+        columns = {}
+        for blueprint_name, counts in transfer_summary_by_user['count'].groupby(level='asset_blueprint_name', observed=True):
+            user_counts = counts.droplevel('asset_blueprint_name').reindex(users, fill_value=0)
+            columns[blueprint_name] = pd.arrays.SparseArray(user_counts.to_numpy(), fill_value=0)
+        transfer_counts_by_user = pd.DataFrame(columns, index=users)
+    else:
+        check_summary_layout(layout)
 
     return transfer_counts_by_user, transfer_counts
 
 
-async def create_transfer_output_files(transfers: list[Transfer], assets: list[Asset],direction: str, output_dir: Path, file_prefix: str) -> None:
-    assets = list(set(assets))
-    transfer_dicts = [await transfer.to_dict() for transfer in transfers]
-    write_list_of_dicts_to_csv(output_dir / f"{file_prefix} transfers {direction}.csv", transfer_dicts)
-    await write_list_of_tortoise_objects_to_csv(output_dir / f"{file_prefix} transferred {direction} assets.csv", assets)
-    transfer_counts_by_user, transfer_counts = await create_transfer_summaries(transfer_dicts, direction)
-    transfer_counts_by_user.to_csv(output_dir / f"{file_prefix} transfer {direction} counts by user.csv")
-    transfer_counts.to_csv(output_dir / f"{file_prefix} transfer {direction} counts.csv")
+async def create_transfer_output_files_from_pages(
+    pages: AsyncIterable[tuple[list[Transfer], list[Asset]]],
+    direction: str,
+    output_dir: Path,
+    file_prefix: str,
+    output_format: str = "csv",
+    summary_layout: str = DEFAULT_SUMMARY_LAYOUT,
+) -> None:
+    # Writes each page of transfers as a search yields it. Only the ids of the assets are kept, for writing the assets
+    # file from the database a chunk at a time, and the summaries are built up from a chunk of transfers at a time
+    index_col = get_summary_index_col(direction)
+    asset_ids: dict[str, None] = {}
+    unsummarised: list[dict] = []
+    chunk_summaries: list[pd.DataFrame] = []
+    summary = get_transfer_chunk_summary([], index_col)
+
+    def summarise_chunk() -> None:
+        nonlocal summary
+        with get_metrics().timed("pandas", rows=len(unsummarised)):
+            chunk_summaries.append(get_transfer_chunk_summary(unsummarised, index_col))
+            unsummarised.clear()
+            # Merged in once the chunks are as long as the summary so far, so each row is only merged a few times
+            if sum(map(len, chunk_summaries)) >= len(summary):
+                summary = merge_transfer_chunk_summaries([summary, *chunk_summaries], index_col)
+                chunk_summaries.clear()
+
+    async def iterate_transfer_rows() -> AsyncIterator[dict]:
+        async with aclosing(pages) as transfer_pages:
+            async for transfers, page_assets in transfer_pages:
+                asset_ids.update(dict.fromkeys(asset.id for asset in page_assets))
+                with get_metrics().timed("db"):
+                    transfer_dicts = await Transfer.to_dicts(transfers)
+                for transfer_dict in transfer_dicts:
+                    unsummarised.append(transfer_dict)
+                    if len(unsummarised) >= EXPORT_CHUNK_SIZE:
+                        summarise_chunk()
+                    yield transfer_dict
+
+    await write_rows(get_output_path(output_dir, f"{file_prefix} transfers {direction}", output_format), iterate_transfer_rows(), Transfer, output_format)
+    await write_rows(get_output_path(output_dir, f"{file_prefix} transferred {direction} assets", output_format), iterate_page_rows(iterate_objects_by_id(Asset, list(asset_ids))), Asset, output_format)
+    summarise_chunk()
+    with get_metrics().timed("pandas"):
+        summary = merge_transfer_chunk_summaries([summary, *chunk_summaries], index_col)
+        transfer_counts_by_user, transfer_counts = await create_transfer_summaries_from_chunk_summary(summary, direction, summary_layout)
+    write_dataframe(transfer_counts_by_user, get_output_path(output_dir, f"{file_prefix} transfer {direction} counts by user", output_format), output_format)
+    write_dataframe(transfer_counts, get_output_path(output_dir, f"{file_prefix} transfer {direction} counts", output_format), output_format)
+
+
+async def create_transfer_output_files(transfers: list[Transfer], assets: list[Asset], direction: str, output_dir: Path, file_prefix: str, output_format: str = "csv", summary_layout: str = DEFAULT_SUMMARY_LAYOUT) -> None:
+    await create_transfer_output_files_from_pages(iterate_list([(transfers, assets)]), direction, output_dir, file_prefix, output_format, summary_layout)
 
 
 @asynccontextmanager
@@ -66,5 +414,6 @@ async def log_exceptions(app):
     try:
         yield
     except Exception:
+        app.searcher.progress.flush()  # So the traceback comes after the messages logged before it
         log = app.query_one("#log", RichLog)
         log.write(Traceback())